@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import deque
+from scheduler import Priority
+
+class SlidingWindow:
+    """
+    Sum of amounts added over the last window seconds, kept in buckets of
+    window/buckets seconds with a running total so reads are O(1) amortized.
+    """
+    def __init__(self, window, buckets=60):
+        self.window = window
+        self.bucket = window / buckets
+        self.entries = deque()
+        self.total = 0
+
+    def expire(self, now):
+        while self.entries and self.entries[0][0] <= now - self.window:
+            self.total -= self.entries.popleft()[1]
+        if not self.entries:
+            # Drop float drift while idle
+            self.total = 0
+
+    def add(self, amount, now):
+        start = now - now % self.bucket
+        if self.entries and self.entries[-1][0] == start:
+            self.entries[-1][1] += amount
+        else:
+            self.entries.append([start, amount])
+        self.total += amount
+
+    def sum(self, now):
+        self.expire(now)
+        return self.total
+
+class AirtimeLedger:
+    """
+    Airtime we transmitted and heard, as the firmware accounts it: TX
+    utilisation over the last hour against the region's duty cycle, and
+    channel utilisation (everything on the air, ours included) over the last
+    minute.
+
+    Relays and periodic traffic are only allowed while TX utilisation is below
+    politeDutyCycle percent of the duty cycle and channel utilisation is below
+    channelLimit percent. Our own messages and ACKs always go.
+    """
+    def __init__(self, dutyCycle=100, politeDutyCycle=50, channelLimit=25, txWindow=3600, channelWindow=60):
+        self.dutyCycle = dutyCycle
+        self.politeDutyCycle = politeDutyCycle
+        self.channelLimit = channelLimit
+        self.tx = SlidingWindow(txWindow)
+        self.channelTx = SlidingWindow(channelWindow)
+        self.channelRx = SlidingWindow(channelWindow)
+        self.lock = threading.Lock()
+        # Frames held back, each counted once
+        self.deferred = 0
+
+    def addTx(self, seconds, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.tx.add(seconds, now)
+            self.channelTx.add(seconds, now)
+
+    def addRx(self, seconds, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.channelRx.add(seconds, now)
+
+    def txUtilization(self, now=None):
+        """
+        Return:
+            percent of the TX window we spent transmitting
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return self.tx.sum(now) / self.tx.window * 100
+
+    def channelUtilization(self, now=None):
+        """
+        Return:
+            percent of the channel window the air was busy, by us or anyone we heard
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return (self.channelTx.sum(now) + self.channelRx.sum(now)) / self.channelRx.window * 100
+
+    def allows(self, priority, now=None):
+        """
+        Whether a frame of priority may be sent now. Deferral is monotonic in
+        priority: if a priority is deferred, every lower one is too.
+        """
+        if priority < Priority.RELAY:
+            return True
+        if now is None:
+            now = time.time()
+        with self.lock:
+            tx = self.tx.sum(now) / self.tx.window * 100
+            channel = (self.channelTx.sum(now) + self.channelRx.sum(now)) / self.channelRx.window * 100
+        return tx < self.dutyCycle * self.politeDutyCycle / 100 and channel < self.channelLimit
+
+    def defer(self):
+        """
+        Counts a frame allows() held back, once per frame
+        """
+        with self.lock:
+            self.deferred += 1
+
+    @property
+    def stats(self):
+        now = time.time()
+        tx = self.txUtilization(now)
+        channel = self.channelUtilization(now)
+        with self.lock:
+            deferred = self.deferred
+        return {
+            "tx_utilization": tx,
+            "channel_utilization": channel,
+            "deferred": deferred,
+        }
@@ -0,0 +1,240 @@
+"""
+Benchmarks of the RX/TX hot path, no hardware needed.
+
+    python3 bench.py                        # print results as JSON
+    python3 bench.py -o bench.json          # save them
+    python3 bench.py -b bench.json          # compare against a saved baseline, exit 1 if a transfer count grew
+
+Throughput is too noisy to fail on, drops beyond the tolerance are only flagged.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# Hot path samples
+TEXT_FRAME = b'\xff\xff\xff\xffp\x87\xa8\xbb\xe0\xa5/^c\x08\x00\x00\x01\x8ey=\x87\xfc4\xdc\xbd#'
+
+# Throughput drops beyond this are flagged, transfer counts may not grow at all
+TOLERANCE = 0.2
+
+def rate(fn, duration=0.2, repeat=7):
+    """
+    Return:
+        median calls per second of fn over repeat runs of about duration seconds
+    """
+    rates = []
+    for _ in range(repeat):
+        n = 0
+        t0 = time.perf_counter()
+        while True:
+            for _ in range(100):
+                fn()
+            n += 100
+            elapsed = time.perf_counter() - t0
+            if elapsed >= duration:
+                break
+        rates.append(n / elapsed)
+    return statistics.median(rates)
+
+class BenchDevice:
+    """
+    Transceiver stand-in that hears the same frame on every wait_rx() and sends instantly.
+    """
+    def __init__(self, frame):
+        self.frame = frame
+        self.sent = 0
+
+    def receive(self):
+        pass
+
+    def wait_rx(self, timeout=3):
+        return True
+
+    def read_payload(self):
+        return self.frame
+
+    def readRssiSnr(self):
+        return -80.0, 8.0
+
+    def send(self, data):
+        self.sent += 1
+        return True
+
+    def lbtBackoff(self, attempt):
+        return 0
+
+    def relayDelay(self, snr):
+        return 0
+
+    def relayWindow(self):
+        return 1
+
+    def hopTime(self, length):
+        return 0
+
+    def timeOnAir(self, length):
+        return 0
+
+def benchPacket(results):
+    from meshtastic.protobuf import mesh_pb2, portnums_pb2
+    from packet import MeshPacket, DEFAULT_KEY
+
+    data = mesh_pb2.Data()
+    data.portnum = portnums_pb2.PortNum.TEXT_MESSAGE_APP
+    data.payload = b"benchmark"
+    packet = MeshPacket.new(b"\xff\xff\xff\xff", b"\x66\x55\x66\x55", data, DEFAULT_KEY)
+    parsed = MeshPacket.parse(TEXT_FRAME, DEFAULT_KEY)
+
+    results["packet.parse_header"] = rate(lambda: MeshPacket.parse(TEXT_FRAME, DEFAULT_KEY))
+    results["packet.parse_full"] = rate(lambda: MeshPacket.parse(TEXT_FRAME, DEFAULT_KEY).protocolData)
+    results["packet.bytes"] = rate(lambda: packet.bytes)
+    results["packet.rebroadcast"] = rate(lambda: parsed.rebroadcast(b"\x55"))
+
+def makeClient(tmp, frame):
+    from sqlalchemy import create_engine
+    import models
+    from main import Client
+
+    url = "sqlite:///" + os.path.join(tmp, "bench.db")
+    models.Base.metadata.create_all(create_engine(url))
+    cfg = {
+        "macaddr": "334455667788",
+        "mute": "false",
+        "short_name": "mspy",
+        "long_name": "Meshtastic.py",
+        "hw_model": "84",
+        "is_licensed": "false",
+        "public_key": "",
+    }
+    return Client(BenchDevice(frame), cfg, db=url, start=False)
+
+def benchClient(results, tmp):
+    from meshtastic.protobuf import mesh_pb2, portnums_pb2
+    from packet import MeshPacket, DEFAULT_KEY
+
+    user = mesh_pb2.User(id="!55665566", long_name="Bench", short_name="bnch", hw_model=84, public_key=bytes(32))
+    data = mesh_pb2.Data(portnum=portnums_pb2.PortNum.NODEINFO_APP, payload=user.SerializeToString())
+    nodeInfo = MeshPacket.new(b"\xff\xff\xff\xff", b"\x66\x55\x66\x55", data, DEFAULT_KEY).bytes
+
+    # Handler dispatch, NODEINFO ends in a SQLite write
+    client = makeClient(tmp, nodeInfo)
+    def handle():
+        packet = MeshPacket.parse(nodeInfo, client.channels, client.pki, client.ports)
+        client.ports.dispatch(client, packet, time.time())
+    results["node.handle_nodeinfo"] = rate(handle)
+
+    # A full loop iteration on a new frame every time
+    client = makeClient(tmp, TEXT_FRAME)
+    client.last_node_info_report = time.time()
+    frame = bytearray(TEXT_FRAME)
+    counter = [0]
+    def poll():
+        counter[0] += 1
+        frame[8:12] = counter[0].to_bytes(4, "little")
+        client.device.frame = bytes(frame)
+        client.poll()
+    results["client.poll"] = rate(poll)
+
+    # The same frame heard again and again via other relays
+    client = makeClient(tmp, TEXT_FRAME)
+    client.last_node_info_report = time.time()
+    results["client.poll_duplicate"] = rate(client.poll)
+
+def benchScheduler(results):
+    from main import PendingTX
+    from scheduler import TxScheduler, Priority
+
+    # Steady state with thousands of frames pending
+    scheduler = TxScheduler()
+    priorities = list(Priority)
+    for i in range(5000):
+        scheduler.push(PendingTX(i.to_bytes(4, "little"), b"", 1, priorities[i % len(priorities)]), 1000 + i)
+    counter = [5000]
+    def cycle():
+        counter[0] += 1
+        i = counter[0]
+        scheduler.push(PendingTX(i.to_bytes(4, "little"), b"", 1, priorities[i % len(priorities)]), i)
+        scheduler.cancel((i - 2500).to_bytes(4, "little"))
+        scheduler.pop(i)
+    results["scheduler.push_cancel_pop"] = rate(cycle)
+
+def benchDrivers(results):
+    from emulator import EmulatedSpiController, SX126xChip, SX127xChip
+    from sx126x import SX126x
+    from sx127x import SX127x
+
+    for name, cls, chip in (("sx126x", SX126x, SX126xChip()), ("sx127x", SX127x, SX127xChip())):
+        spi = EmulatedSpiController(chip)
+        # Batched SX126x commands, off by default until checked on hardware
+        xcvr = cls(0, {"batch": "true"}, spi=spi)
+        xcvr.standby()
+        xcvr.setMeshtastic("TW", "SHORT_FAST")
+        xcvr.receive()
+
+        spi.reset()
+        xcvr.send(TEXT_FRAME)
+        results[f"{name}.tx_transfers"] = spi.stats["transfers"]
+
+        spi.reset()
+        chip.inject(TEXT_FRAME)
+        xcvr.wait_rx()
+        xcvr.read_payload()
+        xcvr.readRssiSnr()
+        xcvr.receive()
+        results[f"{name}.rx_transfers"] = spi.stats["transfers"]
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Return:
+        list of regressed benchmark names, only transfer counts are deterministic enough to count
+    """
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        change = (value - base) / base * 100 if base else 0
+        if name.endswith("_transfers"):
+            regressed = value > base
+            note = "  REGRESSION" if regressed else ""
+        else:
+            regressed = False
+            note = "  slower" if value < base * (1 - tolerance) else ""
+        print(f"{name:28s} {base:14.1f} {value:14.1f} {change:+7.1f}%{note}", file=sys.stderr)
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="RX/TX hot path benchmarks")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="compare against this JSON file")
+    parser.add_argument("-t", "--tolerance", type=float, default=TOLERANCE, help="throughput drop to flag, as a fraction")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        benchPacket(results)
+        benchClient(results, tmp)
+        benchScheduler(results)
+        benchDrivers(results)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
+from virtual import VirtualTransceiver, Medium
+from common import bool_from_str
+
+Record = namedtuple("Record", ["timestamp", "frame", "rssi", "snr", "crcOk"])
+Decoded = namedtuple("Decoded", ["timestamp", "rssi", "snr", "dest", "sender", "packetID", "hopLimit", "channel", "portnum", "payload"])
+
+class Capture:
+    """
+    Append-only log of raw frames as received, with a fixed-width sidecar index.
+
+    Data file: MAGIC, then per frame RECORD (timestamp, rssi, snr, crc ok, length) and the frame.
+    Index file (path + ".idx"): per frame INDEX (timestamp, offset of the record in the data file).
+    """
+    MAGIC = b"MTCAP\x00\x01\x00"
+    RECORD = struct.Struct("<dffBB")
+    INDEX = struct.Struct("<dQ")
+
+    def __init__(self, path):
+        self.path = path
+        self.indexPath = path + ".idx"
+        self.data = None
+        self.index = None
+        self.count = 0
+        self.open()
+
+    def open(self):
+        with open(self.path, "rb") as f:
+            if f.read(len(Capture.MAGIC)) != Capture.MAGIC:
+                raise Exception(f"Capture: Not a capture file {self.path}")
+        if not os.path.exists(self.indexPath):
+            Capture.reindex(self.path)
+        self.dataFile = open(self.path, "rb")
+        self.indexFile = open(self.indexPath, "rb")
+        dataSize = os.fstat(self.dataFile.fileno()).st_size
+        indexSize = os.fstat(self.indexFile.fileno()).st_size
+        self.data = mmap.mmap(self.dataFile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = indexSize // Capture.INDEX.size
+        self.index = mmap.mmap(self.indexFile.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b""
+        # Drop index entries past a record torn by a crash while writing
+        while self.count and self.end(self.count - 1) > dataSize:
+            self.count -= 1
+
+    def close(self):
+        if self.count:
+            self.index.close()
+        self.data.close()
+        self.indexFile.close()
+        self.dataFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def offset(self, i):
+        return Capture.INDEX.unpack_from(self.index, i * Capture.INDEX.size)[1]
+
+    def end(self, i):
+        header = self.offset(i) + Capture.RECORD.size
+        if header > len(self.data):
+            # Torn within the record header, the length byte is not there
+            return header
+        return header + self.data[header - 1]
+
+    def timestamp(self, i):
+        return Capture.INDEX.unpack_from(self.index, i * Capture.INDEX.size)[0]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        offset = self.offset(i)
+        timestamp, rssi, snr, crcOk, length = Capture.RECORD.unpack_from(self.data, offset)
+        start = offset + Capture.RECORD.size
+        return Record(timestamp, self.data[start:start+length], rssi, snr, bool(crcOk))
+
+    def seek(self, timestamp):
+        """
+        Return:
+            index of the first frame at or after timestamp
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start=None, end=None):
+        i = 0 if start is None else self.seek(start)
+        j = self.count if end is None else self.seek(end)
+        for k in range(i, j):
+            yield self[k]
+
+    def __iter__(self):
+        return self.range()
+
+    @staticmethod
+    def reindex(path):
+        """
+        Return:
+            offset of the end of the last complete record
+        """
+        with open(path, "rb") as f, open(path + ".idx", "wb") as idx:
+            data = f.read()
+            offset = len(Capture.MAGIC)
+            while offset + Capture.RECORD.size <= len(data):
+                timestamp, rssi, snr, crcOk, length = Capture.RECORD.unpack_from(data, offset)
+                if offset + Capture.RECORD.size + length > len(data):
+                    break
+                idx.write(Capture.INDEX.pack(timestamp, offset))
+                offset += Capture.RECORD.size + length
+        return offset
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new:
+            with open(path, "rb") as f:
+                if f.read(len(Capture.MAGIC)) != Capture.MAGIC:
+                    raise Exception(f"Capture: Not a capture file {path}")
+            # Cut a record torn by a crash, appending after it would misalign the next reindex
+            end = Capture.reindex(path)
+            if end < os.path.getsize(path):
+                os.truncate(path, end)
+        self.dataFile = open(path, "ab")
+        self.indexFile = open(path + ".idx", "ab")
+        if new:
+            self.dataFile.write(Capture.MAGIC)
+            self.dataFile.flush()
+
+    def write(self, timestamp, frame, rssi=0, snr=0, crcOk=True):
+        offset = self.dataFile.tell()
+        self.dataFile.write(Capture.RECORD.pack(timestamp, rssi or 0, snr or 0, 1 if crcOk else 0, len(frame)))
+        self.dataFile.write(frame)
+        self.dataFile.flush()
+        # The record is complete before it is indexed
+        self.indexFile.write(Capture.INDEX.pack(timestamp, offset))
+        self.indexFile.flush()
+
+    def close(self):
+        self.indexFile.close()
+        self.dataFile.close()
+
+class ReplayTransceiver(VirtualTransceiver):
+    """
+    Plays a capture back as received frames, at the original pace or as fast as
+    Client takes them. Transmissions go to a private medium nobody listens to.
+    """
+    CFG_PATH = "path"
+    CFG_REALTIME = "realtime"
+    CFG_START = "start"
+    CFG_END = "end"
+
+    def __init__(self, params=None):
+        if params is None:
+            params = {}
+        super().__init__(params, Medium())
+        self.params[ReplayTransceiver.CFG_REALTIME] = bool_from_str(params.get(ReplayTransceiver.CFG_REALTIME, "true"))
+        start = params.get(ReplayTransceiver.CFG_START)
+        end = params.get(ReplayTransceiver.CFG_END)
+        self.capture = Capture(params[ReplayTransceiver.CFG_PATH])
+        self.records = self.capture.range(float(start) if start else None, float(end) if end else None)
+        self.record = None
+        self.t0 = None
+        self.first = None
+
+    def wait_rx(self, timeout=3):
+        """
+        Return:
+            True if RX_DONE
+            False if the frame was captured with a CRC error
+            None if RX_TIMEOUT, or the capture is over
+        """
+        record = next(self.records, None)
+        if record is None:
+            time.sleep(timeout)
+            return None
+        if self.params[ReplayTransceiver.CFG_REALTIME]:
+            if self.t0 is None:
+                self.t0 = time.time()
+                self.first = record.timestamp
+            delay = self.t0 + (record.timestamp - self.first) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self.record = record
+        return record.crcOk
+
+    def read_payload(self):
+        return self.record.frame if self.record else b""
+
+    def readRssiSnr(self):
+        return self.record.rssi, self.record.snr
+
+class BulkDecoder:
+    """
+    Decodes a capture with a process pool. Workers map the capture themselves
+    and are only sent index ranges, so each frame is copied once, out of the
+    mmap in the worker. Results come back in capture order.
+    """
+    CHUNK_SIZE = 2000
+
+    # Per worker process
+    worker = None
+
+    def __init__(self, path, channels, workers=None, chunkSize=CHUNK_SIZE):
+        """
+        channels: [(name, psk), ...]
+        workers: number of processes, 0 to decode in this process
+        """
+        self.path = path
+        self.channels = list(channels)
+        self.workers = os.cpu_count() if workers is None else workers
+        self.chunkSize = chunkSize
+
+    @classmethod
+    def init(cls, path, channels):
+        from packet import Channels
+        table = Channels()
+        for name, psk in channels:
+            table.add(name, psk)
+        cls.worker = (Capture(path), table)
+
+    @classmethod
+    def decodeRange(cls, i, j):
+        from packet import MeshPacket
+        capture, channels = cls.worker
+        ret = []
+        for k in range(i, j):
+            record = capture[k]
+            if len(record.frame) < 16:
+                continue
+            packet = MeshPacket.parse(record.frame, channels)
+            data = packet.packetData
+            ret.append(Decoded(
+                record.timestamp, record.rssi, record.snr,
+                packet.dest, packet.sender, packet.packetID, packet.hopLimit, packet.channel,
+                data.portnum if data else None,
+                data.payload if data else None,
+            ))
+        return ret
+
+    def decode(self, start=None, end=None):
+        with Capture(self.path) as capture:
+            i = 0 if start is None else capture.seek(start)
+            j = len(capture) if end is None else capture.seek(end)
+        chunks = ((k, min(k + self.chunkSize, j)) for k in range(i, j, self.chunkSize))
+
+        if self.workers == 0:
+            BulkDecoder.init(self.path, self.channels)
+            for chunk in chunks:
+                yield from BulkDecoder.decodeRange(*chunk)
+            return
+
+        with ProcessPoolExecutor(self.workers, initializer=BulkDecoder.init, initargs=(self.path, self.channels)) as executor:
+            # Bounded window of chunks in flight, results are yielded in order
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(BulkDecoder.decodeRange, *chunk))
+                if len(pending) >= self.workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+if __name__ == "__main__":
+    import sys
+    from packet import MeshPacket, Channels, DEFAULT_CHANNEL, DEFAULT_KEY
+
+    action = sys.argv[1] if len(sys.argv) > 1 else None
+    if action == "info":
+        with Capture(sys.argv[2]) as capture:
+            print(f"{len(capture)} frames")
+            if len(capture):
+                print(f"from {capture.timestamp(0)} to {capture.timestamp(len(capture)-1)}")
+    elif action == "dump":
+        with Capture(sys.argv[2]) as capture:
+            for record in capture:
+                print(record.timestamp, "OK" if record.crcOk else "NG", record.rssi, record.snr, record.frame.hex())
+    elif action == "replay":
+        # Decode every frame as fast as possible
+        channels = Channels()
+        channels.add(DEFAULT_CHANNEL, DEFAULT_KEY)
+        with Capture(sys.argv[2]) as capture:
+            t0 = time.perf_counter()
+            decoded = 0
+            for record in capture:
+                if len(record.frame) < 16:
+                    continue
+                packet = MeshPacket.parse(record.frame, channels)
+                if packet.protocolData or packet.packetData:
+                    decoded += 1
+            elapsed = time.perf_counter() - t0
+            print(f"{decoded}/{len(capture)} frames decoded in {elapsed:.3f}s, {len(capture)/elapsed:.0f} frames/s")
+    elif action == "synth":
+        # Synthetic capture for benchmarks
+        path = sys.argv[2]
+        n = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+        from meshtastic.protobuf import mesh_pb2, portnums_pb2
+        user = mesh_pb2.User(id="!55665566", long_name="Meshtastic.py", short_name="mspy", public_key=bytes(32))
+        position = mesh_pb2.Position(latitude_i=250000000, longitude_i=1215000000, altitude=10)
+        frames = [
+            b'\xff\xff\xff\xffp\x87\xa8\xbb\xe0\xa5/^c\x08\x00\x00\x01\x8ey=\x87\xfc4\xdc\xbd#',
+            MeshPacket.new(b"\xff\xff\xff\xff", b"\x66\x55\x66\x55", mesh_pb2.Data(portnum=portnums_pb2.PortNum.NODEINFO_APP, payload=user.SerializeToString()), DEFAULT_KEY).bytes,
+            MeshPacket.new(b"\xff\xff\xff\xff", b"\x66\x55\x66\x55", mesh_pb2.Data(portnum=portnums_pb2.PortNum.POSITION_APP, payload=position.SerializeToString()), DEFAULT_KEY).bytes,
+        ]
+        writer = CaptureWriter(path)
+        t = time.time()
+        for i in range(n):
+            writer.write(t + i, frames[i % len(frames)], -80, 8, True)
+        writer.close()
+        print(f"{n} frames written to {path}")
+    elif action == "bulk":
+        # Process pool against the single-process baseline
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        channels = [(DEFAULT_CHANNEL, DEFAULT_KEY)]
+        results = {}
+        for n in (0, workers):
+            decoder = BulkDecoder(sys.argv[2], channels, n)
+            t0 = time.perf_counter()
+            count = sum(1 for d in decoder.decode())
+            elapsed = time.perf_counter() - t0
+            if not count:
+                print(f"workers={decoder.workers}: no frames")
+                continue
+            results[decoder.workers] = count / elapsed
+            print(f"workers={decoder.workers}: {count} frames in {elapsed:.3f}s, {count/elapsed:.0f} frames/s")
+        if results.get(0) and results.get(decoder.workers):
+            print(f"speedup: {results[decoder.workers] / results[0]:.2f}x")
+    else:
+        print(f"Usage: {sys.argv[0]} info|dump|replay <capture>")
+        print(f"       {sys.argv[0]} bulk <capture> [workers]")
+        print(f"       {sys.argv[0]} synth <capture> [frames]")
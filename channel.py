@@ -2,8 +2,9 @@ from meshtastic.protobuf import mesh_pb2, portnums_pb2
 from common import *
 
 class Channel():
-    def __init__(self, id, name):
+    def __init__(self, id, name, key=None):
         self.id = id
+        self.key = key
         self.state = State()
         self.state.name = name
 
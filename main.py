@@ -3,7 +3,13 @@ import radio
 import time
 from node import *
 from channel import *
-from packet import DEFAULT_KEY, MeshPacket
+from packet import DEFAULT_KEY, DEFAULT_CHANNEL, Channels, MeshPacket
+from pki import PKI
+from ports import Ports
+from seen import SeenCache
+from scheduler import TxScheduler, Priority
+from rtt import RttEstimator
+from airtime import AirtimeLedger
 import threading
 import meshtastic.protobuf.config_pb2
 from common import *
@@ -11,29 +17,62 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 from sqlalchemy import select, delete
 import models
+import atexit
 import json
 import os
 import configparser
+import logging
+import logging.handlers
+import queue
 
 BASE_DIR = os.path.dirname(__file__)
 
-DEVICE_HARDWARE = json.load(open(os.path.join(BASE_DIR, "Meshtastic-Android/app/src/main/assets/device_hardware.json")))
+logger = logging.getLogger("client")
+
+try:
+    DEVICE_HARDWARE = json.load(open(os.path.join(BASE_DIR, "Meshtastic-Android/app/src/main/assets/device_hardware.json")))
+except FileNotFoundError:
+    # Submodule not checked out, hardware models are shown as numbers
+    DEVICE_HARDWARE = []
 
 RETRY_INTERVAL = 7
-PACKET_LOOKBACK_TTL = 30
+SEEN_TTL = 600
+SEEN_SIZE = 1024
 NODE_INFO_REPORT_INTERVAL = 3600
+AIRTIME_REPORT_INTERVAL = 600
 
 class PendingTX():
-    def __init__(self, packetID, payload, retry):
+    __slots__ = ("packetID", "payload", "retry", "priority", "lifetime", "dest", "wantAck", "attempts", "last", "busy", "cancelled")
+
+    def __init__(self, packetID, payload, retry, priority=Priority.TEXT, dest=None, wantAck=False, lifetime=None):
         self.packetID = packetID
         self.payload = payload
         self.retry = retry
+        self.priority = priority
+        # Seconds past due after which the scheduler drops it unsent, None to keep it until sent
+        self.lifetime = lifetime
+        # With wantAck, retried until a ROUTING_APP ACK/NAK from dest instead of until heard relayed
+        self.dest = dest
+        self.wantAck = wantAck
+        self.attempts = 0
         self.last = 0
-        self.acked = 0
+        # Listen before talk backoff
+        self.busy = 0
+        self.cancelled = False
 
 class Client():
-    def __init__(self, device, cfg):
+    def __init__(self, device, cfg, channels=None, capture=None, airtime=None, db="sqlite:///meshtastic.db", start=True):
         self.device = device
+        # Airtime ledger, relays and NodeInfo are deferred when it runs out
+        if airtime is None:
+            airtime = AirtimeLedger()
+        self.airtime = airtime
+        # CaptureWriter recording every frame heard
+        self.capture = capture
+        if channels is None:
+            channels = Channels()
+            channels.add(DEFAULT_CHANNEL, DEFAULT_KEY)
+        self.channels = channels
         self.state = State()
 
         self.addr = bytes.fromhex(cfg["macaddr"])[-4:][::-1]
@@ -44,26 +83,51 @@ class Client():
         self.state.hw_model = int(cfg["hw_model"])
         self.state.is_licensed = bool_from_str(cfg["is_licensed"])
         self.state.public_key = bytes.fromhex(cfg["public_key"])
-
-        print("Address", self.addr[::-1].hex())
-        print("Short Name", self.state.short_name)
-        print("Long Name", self.state.long_name)
-        print("MAC Address", self.state.macaddr.hex())
-        print("HW Model", self.state.hw_model)
-        print("Is Licensed", self.state.is_licensed)
-        print("Public Key", self.state.public_key.hex())
+        self.pki = None
+        if cfg.get("private_key"):
+            self.pki = PKI(bytes.fromhex(cfg["private_key"]), self.addr, self.publicKeyOf)
+            if not self.state.public_key:
+                self.state.public_key = self.pki.publicKey
+
+        logger.info("address=%s short_name=%s long_name=%s macaddr=%s hw_model=%s is_licensed=%s public_key=%s",
+            self.addr[::-1].hex(),
+            self.state.short_name,
+            self.state.long_name,
+            self.state.macaddr.hex(),
+            self.state.hw_model,
+            self.state.is_licensed,
+            self.state.public_key.hex(),
+        )
 
         self.state.lat = 0
         self.state.lng = 0
         self.state.channels = []
-        self.state.channels.append(Channel(radio.Meshtastic.BROADCAST_ADDR.hex(), "Public Channel"))
+        for entry in self.channels.entries:
+            self.state.channels.append(Channel(radio.Meshtastic.BROADCAST_ADDR.hex(), entry.name, entry))
         self.state.nodes = {}
-        self.txPool = []
-        self.thread = threading.Thread(target=self.looper, daemon=True)
-        self.thread.start()
+        self.scheduler = TxScheduler(self.airtime)
+        # Relays dropped because another node relayed first
+        self.relaysCancelled = 0
+        # (sender, packetID) of everything handled, duplicates heard via other relays are dropped
+        self.seen = SeenCache(SEEN_TTL, SEEN_SIZE)
+        # Retransmit timeouts of wantAck packets, per destination
+        self.rtt = RttEstimator()
+        self.ports = Ports()
+        Node.register(self.ports)
+        self.ports.subscribe(portnums_pb2.PortNum.ROUTING_APP, Client.handleRouting)
         self.last_node_info_report = 0
-        self.db = create_engine('sqlite:///meshtastic.db')
+        self.last_airtime_report = time.time()
+        self.db = create_engine(db)
         self.checkout()
+        self.thread = threading.Thread(target=self.looper, daemon=True)
+        if start:
+            self.thread.start()
+
+    def publicKeyOf(self, addr):
+        node = self.state.nodes.get(addr)
+        if node is None or not node.state.public_key:
+            return None
+        return bytes.fromhex(node.state.public_key)
 
     def checkout(self):
         with Session(self.db) as sess:
@@ -80,52 +144,127 @@ class Client():
                 self.state.nodes[bytes.fromhex(n.id)] = node
 
     def looper(self):
-        from datetime import datetime
+        # Armed once, the driver keeps listening across TX and errors
+        self.device.receive()
         while True:
-            self.device.receive()
-
-            # print("Receive")
-            ok = self.device.wait_rx()
-            # print("Wait rx")
-
-            if ok is not None:
-                payload = self.device.read_payload()
-                print(datetime.now().strftime("[%Y-%m-%d %H:%M:%S]"), "OK" if ok else "NG", payload)
-                if len(payload) < 16:
-                    continue
-
-                packet = MeshPacket.parse(payload, DEFAULT_KEY)
-                packet.print()
-
-                packet.rssi, packet.snr = self.device.readRssiSnr()
-
-                prev = [p for p in self.txPool if p.packetID == packet.packetID]
-                if prev:
-                    for p in prev:
-                        p.acked = time.time()
-                else:
-                    Node.handle(self, packet, time.time())
-                    if not self.mute:
-                        rebroadcast = packet.rebroadcast()
-                        if rebroadcast:
-                            self.txPool.append(PendingTX(packet.packetID, rebroadcast, 2))
-
-            now = time.time()
-            self.txPool = [p for p in self.txPool if p.acked==0 or now - p.acked < PACKET_LOOKBACK_TTL]
-
-            todo = [p for p in self.txPool if p.acked==0 and p.retry>0]
-            # print("Todo", len(todo))
-            todo.sort(key=lambda x:x.last)
-            if todo:
-                p = todo[0]
-                if now - p.last > RETRY_INTERVAL:
-                    print(f"Send retry={p.retry} {p.payload}")
-                    self.device.send(p.payload)
-                    p.last = now
-                    p.retry -= 1
-            elif now - self.last_node_info_report > NODE_INFO_REPORT_INTERVAL:
-                self.last_node_info_report = now
-                self.sendNodeInfo()
+            self.poll()
+
+    def poll(self):
+        """
+        One iteration of the loop: wait for a frame, handle it, then send at most one pending frame
+        """
+        # print("Receive")
+        ok = self.device.wait_rx()
+        # print("Wait rx")
+
+        if ok is not None:
+            payload = self.device.read_payload()
+            rssi, snr = self.device.readRssiSnr()
+            logger.info("rx %s len=%d rssi=%s snr=%s", "OK" if ok else "NG", len(payload), rssi, snr, extra={"event": "rx"})
+            logger.debug("rx payload=%s", payload)
+            if self.capture:
+                self.capture.write(time.time(), payload, rssi, snr, ok)
+            self.airtime.addRx(self.device.timeOnAir(len(payload)))
+            # A corrupted copy must not mark the packet seen, the good one may still come via another relay
+            if ok and len(payload) >= 16:
+                self.handleFrame(payload, rssi, snr)
+
+        now = time.time()
+        p = self.scheduler.pop(now)
+        if p is not None and p.retry == 0:
+            # Waited out the last retransmission of a wantAck packet
+            logger.warning("no ack id=%s dest=%s attempts=%d", p.packetID.hex(), p.dest.hex(), p.attempts, extra={"event": "nak"})
+        elif p is not None:
+            logger.info("tx id=%s retry=%d len=%d", p.packetID.hex(), p.retry, len(p.payload), extra={"event": "tx"})
+            try:
+                sent = self.device.send(p.payload)
+            except radio.TxTimeout as e:
+                logger.warning("%s", e)
+                sent = True
+            if not sent:
+                # Channel busy, back off without spending a retry
+                p.busy += 1
+                self.scheduler.push(p, time.time() + self.device.lbtBackoff(p.busy))
+                return
+            p.busy = 0
+            p.last = now
+            self.airtime.addTx(self.device.timeOnAir(len(p.payload)), now)
+            p.attempts += 1
+            p.retry -= 1
+            if p.wantAck:
+                # Until ACKed, backing off from the RTO to the destination; after the last attempt this waits for a late ACK
+                self.scheduler.push(p, now + self.rtt.timeout(p.dest, p.attempts, self.device.hopTime(len(p.payload))))
+            elif p.retry > 0:
+                # Until cancelled by hearing it relayed
+                self.scheduler.push(p, now + RETRY_INTERVAL)
+        elif now - self.last_node_info_report > NODE_INFO_REPORT_INTERVAL:
+            self.last_node_info_report = now
+            self.sendNodeInfo()
+        if now - self.last_airtime_report > AIRTIME_REPORT_INTERVAL:
+            self.last_airtime_report = now
+            self.reportAirtime(now)
+
+    def handleFrame(self, payload, rssi, snr):
+        """
+        Handle a frame received intact: dedup, ACK, dispatch and relay
+        """
+        # Header only, the payload is decrypted and parsed on first use
+        packet = MeshPacket.parse(payload, self.channels, self.pki, self.ports)
+
+        packet.rssi, packet.snr = rssi, snr
+        if packet.hopStart:
+            self.rtt.observeHops(packet.sender, packet.hopStart - packet.hopLimit)
+
+        pending = self.scheduler.get(packet.packetID)
+        if pending is None or pending.payload[4:8] != packet.sender:
+            # Packet IDs are only unique per sender
+            cancelled = None
+        elif pending.wantAck:
+            # Relayed is not delivered, only the ACK stops it
+            cancelled = None
+        else:
+            cancelled = self.scheduler.cancel(packet.packetID)
+        if cancelled:
+            # Our own frame relayed back, or someone else relayed what we were going to
+            logger.debug("cancel id=%s", packet.packetID.hex(), extra={"event": "cancel"})
+            if cancelled.priority == Priority.RELAY and cancelled.last == 0:
+                self.relaysCancelled += 1
+        if self.seen.check((packet.sender, packet.packetID)):
+            logger.debug("seen id=%s sender=%s", packet.packetID.hex(), packet.sender.hex(), extra={"event": "seen"})
+            if packet.wantAck and packet.dest == self.addr and packet.hopStart == packet.hopLimit:
+                # Retransmitted by the sender itself, our ACK was lost
+                self.sendAck(packet)
+        else:
+            if packet.wantAck and packet.dest == self.addr:
+                self.sendAck(packet)
+            if logger.isEnabledFor(logging.DEBUG):
+                # Decrypts and parses everything, only when asked for
+                logger.debug("packet\n%s", packet.describe())
+            self.ports.dispatch(self, packet, time.time())
+            if not self.mute and packet.dest != self.addr:
+                # Frames for us have arrived, flooding them further only spends airtime
+                rebroadcast = packet.rebroadcast(self.addr[0:1])
+                if rebroadcast:
+                    # Held for an SNR-weighted contention window, cancelled if someone else relays first
+                    delay = self.device.relayDelay(snr)
+                    logger.debug("relay id=%s snr=%s delay=%.3f", packet.packetID.hex(), snr, delay, extra={"event": "relay"})
+                    # Stale once a whole contention window late, e.g. held back by the airtime budget
+                    relay = PendingTX(packet.packetID, rebroadcast, 2, Priority.RELAY, lifetime=self.device.relayWindow())
+                    self.queue(relay, due=time.time() + delay)
+
+    def reportAirtime(self, now=None):
+        stats = self.airtime.stats
+        self.state.tx_utilization = stats["tx_utilization"]
+        self.state.channel_utilization = stats["channel_utilization"]
+        logger.info("airtime tx=%.2f%% channel=%.2f%% deferred=%d expired=%d relays_cancelled=%d pending=%d",
+            stats["tx_utilization"], stats["channel_utilization"], stats["deferred"], self.scheduler.expired, self.relaysCancelled, len(self.scheduler),
+            extra={"event": "airtime"})
+
+    def queue(self, pending, sender=None, due=None):
+        self.scheduler.push(pending, time.time() if due is None else due)
+        if sender is not None:
+            # Our own packets, their echoes are not handled as new
+            self.seen.add((sender, pending.packetID))
 
     def sendNodeInfo(self):
         packetPayload = mesh_pb2.Data()
@@ -148,8 +287,49 @@ class Client():
         packetPayload.reply_id = 0
         packetPayload.emoji = 0
         packetPayload.bitfield = 0
-        packet = MeshPacket.new(radio.Meshtastic.BROADCAST_ADDR, self.addr, packetPayload, DEFAULT_KEY)
-        self.txPool.append(PendingTX(packet.packetID, packet.bytes, 2))
+        packet = MeshPacket.new(radio.Meshtastic.BROADCAST_ADDR, self.addr, packetPayload, self.channels.primary)
+        self.queue(PendingTX(packet.packetID, packet.bytes, 2, Priority.PERIODIC), self.addr)
+
+    def sendAck(self, packet):
+        """
+        ACK a wantAck packet addressed to us, or NAK it if we cannot decode it
+        """
+        routing = mesh_pb2.Routing()
+        if packet.packetData is not None:
+            routing.error_reason = mesh_pb2.Routing.Error.NONE
+        elif packet.pki is not None:
+            routing.error_reason = mesh_pb2.Routing.Error.PKI_UNKNOWN_PUBKEY
+        else:
+            routing.error_reason = mesh_pb2.Routing.Error.NO_CHANNEL
+        packetPayload = mesh_pb2.Data()
+        packetPayload.portnum = portnums_pb2.PortNum.ROUTING_APP
+        packetPayload.payload = routing.SerializeToString()
+        packetPayload.request_id = int.from_bytes(packet.packetID, "little")
+        # Back the way it came: PKI, or the channel it was heard on
+        channel = self.channels.get(packet.channel) or self.channels.primary
+        ack = MeshPacket.new(packet.sender, self.addr, packetPayload, channel, pkiKey=packet.pkiKey)
+        logger.debug("ack id=%s dest=%s error=%s", packet.packetID.hex(), packet.sender.hex(), routing.error_reason, extra={"event": "ack"})
+        self.queue(PendingTX(ack.packetID, ack.bytes, 1, Priority.ROUTING), self.addr)
+
+    def handleRouting(self, packet, timestamp):
+        """
+        ROUTING_APP handler, called as handler(master, packet, timestamp)
+        """
+        if packet.dest != self.addr or not packet.packetData.request_id:
+            return
+        packetID = packet.packetData.request_id.to_bytes(4, "little")
+        pending = self.scheduler.get(packetID)
+        if pending is None or not pending.wantAck:
+            return
+        self.scheduler.cancel(packetID)
+        routing = packet.protocolData
+        if routing is None or routing.error_reason == mesh_pb2.Routing.Error.NONE:
+            if pending.attempts == 1:
+                # Retransmitted ones are ambiguous, the ACK may be for any attempt (Karn)
+                self.rtt.sample(pending.dest, timestamp - pending.last)
+            logger.info("ack id=%s from=%s attempts=%d", packetID.hex(), packet.sender.hex(), pending.attempts, extra={"event": "ack"})
+        else:
+            logger.warning("nak id=%s from=%s error=%s", packetID.hex(), packet.sender.hex(), mesh_pb2.Routing.Error.Name(routing.error_reason), extra={"event": "nak"})
 
     def updateNode(self, node):
         with Session(self.db) as sess:
@@ -170,13 +350,15 @@ class Client():
             sess.commit()
 
     def forgetNode(self, node):
-        print("Forget", node.id)
+        logger.info("forget %s", node.id)
         with Session(self.db) as sess:
             sess.execute(delete(models.Node).where(models.Node.id == node.id))
             sess.commit()
         self.state.nodes.pop(bytes.fromhex(node.id), None)
 
-    def send(self, dest, message):
+    def send(self, dest, message, channel=None):
+        if channel is None:
+            channel = self.channels.primary
         if type(dest) is str:
             dest = bytes.fromhex(dest)
         packetPayload = mesh_pb2.Data()
@@ -189,9 +371,15 @@ class Client():
         packetPayload.reply_id = 0
         packetPayload.emoji = 0
         packetPayload.bitfield = 0
-        packet = MeshPacket.new(dest, self.addr, packetPayload, DEFAULT_KEY)
-
-        self.txPool.append(PendingTX(packet.packetID, packet.bytes, 3))
+        pkiKey = None
+        if self.pki is not None and dest != radio.Meshtastic.BROADCAST_ADDR:
+            # Direct message, encrypted to the peer if we know its public key
+            pkiKey = self.pki.keyFor(dest)
+        packet = MeshPacket.new(dest, self.addr, packetPayload, channel, pkiKey=pkiKey)
+        wantAck = dest != radio.Meshtastic.BROADCAST_ADDR
+        packet.wantAck = int(wantAck)
+
+        self.queue(PendingTX(packet.packetID, packet.bytes, 3, Priority.TEXT, dest, wantAck), self.addr)
         node = Node.get(self.state.nodes, dest)
         node.state.messages.append(Message(dest, self.addr, message, time.time()))
 
@@ -267,12 +455,34 @@ class App(Application):
     def sendMessage(self, e):
         if self.state.edit == "":
             return
-        self.client.send(self.state.focus.id, self.state.edit)
+        if isinstance(self.state.focus, Channel):
+            self.client.send(self.state.focus.id, self.state.edit, self.state.focus.key)
+        else:
+            self.client.send(self.state.focus.id, self.state.edit)
         self.state.edit = ""
 
     def select(self, e, item):
         self.state.focus = item
 
+def setupLogging(level):
+    """
+    Records are queued by the caller and written by a listener thread, so a slow
+    stdout or GUI never stalls the radio loop. The listener is stopped at exit,
+    flushing what is still queued.
+    """
+    q = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(q, handler)
+    queued = logging.handlers.QueueHandler(q)
+    # QueueHandler.prepare() merges the %-args (and any traceback) into the message on the
+    # caller's thread, the listener only adds the time, level and logger name
+    queued.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=level.upper(), handlers=[queued], force=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 def main():
     from alembic.config import Config
     from alembic import command
@@ -280,13 +490,17 @@ def main():
     command.upgrade(Config(os.path.join(BASE_DIR, "alembic.ini")), "head")
 
     cfg = configparser.ConfigParser(inline_comment_prefixes="#")
+    # Channel names are case sensitive, they go into the channel hash
+    cfg.optionxform = str
     cfg.read(os.path.join(BASE_DIR, "meshtastic.ini"))
-    print(dict(cfg["meshtastic"]))
+    setupLogging(cfg["logging"].get("level", "INFO") if "logging" in cfg else "INFO")
+    logger.info("config %s", dict(cfg["meshtastic"]))
 
     transceiver = cfg["interface"]["transceiver"]
     if transceiver == "sx127x":
         from sx127x import SX127x
-        sx = SX127x(0)
+        xcvr_cfg = cfg["sx127x"] if "sx127x" in cfg else {}
+        sx = SX127x(0, xcvr_cfg)
         sx.standby()
         sx.setMeshtastic(cfg["radio"]["region"], cfg["radio"]["preset"], cfg["radio"]["slot"])
     elif transceiver == "sx126x":
@@ -295,10 +509,51 @@ def main():
         sx = SX126x(0, xcvr_cfg)
         sx.standby()
         sx.setMeshtastic(cfg["radio"]["region"], cfg["radio"]["preset"], cfg["radio"]["slot"])
+    elif transceiver == "replay":
+        from capture import ReplayTransceiver
+        xcvr_cfg = cfg["replay"] if "replay" in cfg else {}
+        sx = ReplayTransceiver(xcvr_cfg)
+        sx.standby()
+        sx.setMeshtastic(cfg["radio"]["region"], cfg["radio"]["preset"], cfg["radio"]["slot"])
+    elif transceiver == "virtual":
+        from virtual import VirtualTransceiver
+        xcvr_cfg = cfg["virtual"] if "virtual" in cfg else {}
+        sx = VirtualTransceiver(xcvr_cfg)
+        sx.standby()
+        sx.setMeshtastic(cfg["radio"]["region"], cfg["radio"]["preset"], cfg["radio"]["slot"])
     else:
         raise Exception(f"Unsupported transceiver: {transceiver}")
 
-    client = Client(sx, cfg["meshtastic"])
+    sx.setListenBeforeTalk(bool_from_str(cfg["radio"].get("lbt", "true")))
+
+    if "rx_polling" in cfg:
+        polling = cfg["rx_polling"]
+        sx.setRxPolling(
+            float(polling.get("idle_symbols", 16)),
+            float(polling.get("active_symbols", 1)),
+            float(polling.get("min_interval", 0.002)),
+            float(polling.get("max_interval", 0.2)),
+        )
+
+    channels = Channels()
+    if "channels" in cfg:
+        for name, psk in cfg["channels"].items():
+            channels.add(name, psk or DEFAULT_KEY)
+    if not channels.entries:
+        channels.add(DEFAULT_CHANNEL, DEFAULT_KEY)
+
+    capture = None
+    if "capture" in cfg and cfg["capture"].get("record"):
+        from capture import CaptureWriter
+        capture = CaptureWriter(cfg["capture"]["record"])
+
+    airtime = AirtimeLedger(
+        radio.Meshtastic.REGION[cfg["radio"]["region"]]["dutyCycle"],
+        float(cfg["radio"].get("polite_duty_cycle", 50)),
+        float(cfg["radio"].get("channel_util_limit", 25)),
+    )
+
+    client = Client(sx, cfg["meshtastic"], channels, capture, airtime)
 
     app = App(client)
     app.run()
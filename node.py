@@ -36,34 +36,45 @@ class Node():
         return node
 
     @classmethod
-    def handle(cls, master, packet, timestamp):
-        if not packet.packetData:
+    def register(cls, ports):
+        ports.subscribe(portnums_pb2.PortNum.POSITION_APP, cls.handlePosition)
+        ports.subscribe(portnums_pb2.PortNum.NODEINFO_APP, cls.handleNodeInfo)
+        ports.subscribe(portnums_pb2.PortNum.TEXT_MESSAGE_APP, cls.handleText)
+
+    @classmethod
+    def handlePosition(cls, master, packet, timestamp):
+        if not packet.protocolData:
             return
-        if packet.packetData.portnum == portnums_pb2.PortNum.POSITION_APP:
-            if not packet.protocolData:
-                return
-            node = cls.get(master.state.nodes, packet.sender)
-            node.state.lat = packet.protocolData.latitude_i
-            node.state.lng = packet.protocolData.longitude_i
-            node.state.alt = packet.protocolData.altitude
-            master.updateNode(node)
-            node.state.rssi = packet.rssi
-            node.state.snr = packet.snr
-        elif packet.packetData.portnum == portnums_pb2.PortNum.NODEINFO_APP:
-            if not packet.protocolData:
-                return
-            node = cls.get(master.state.nodes, packet.sender)
-            node.state.long_name = packet.protocolData.long_name
-            node.state.short_name = packet.protocolData.short_name
-            node.state.macaddr = packet.protocolData.macaddr.hex()
-            node.state.hw_model = packet.protocolData.hw_model
-            node.state.public_key = packet.protocolData.public_key.hex()
-            node.state.rssi = packet.rssi
-            node.state.snr = packet.snr
-            master.updateNode(node)
-        elif packet.packetData.portnum == portnums_pb2.PortNum.TEXT_MESSAGE_APP:
-            node = cls.get(master.state.nodes, packet.sender)
-            msg = Message(packet.dest, packet.sender, packet.packetData.payload.decode("utf-8"), timestamp)
-            node.state.rssi = packet.rssi
-            node.state.snr = packet.snr
-            node.state.messages.append(msg)
\ No newline at end of file
+        node = cls.get(master.state.nodes, packet.sender)
+        node.state.lat = packet.protocolData.latitude_i
+        node.state.lng = packet.protocolData.longitude_i
+        node.state.alt = packet.protocolData.altitude
+        master.updateNode(node)
+        node.state.rssi = packet.rssi
+        node.state.snr = packet.snr
+
+    @classmethod
+    def handleNodeInfo(cls, master, packet, timestamp):
+        if not packet.protocolData:
+            return
+        node = cls.get(master.state.nodes, packet.sender)
+        node.state.long_name = packet.protocolData.long_name
+        node.state.short_name = packet.protocolData.short_name
+        node.state.macaddr = packet.protocolData.macaddr.hex()
+        node.state.hw_model = packet.protocolData.hw_model
+        public_key = packet.protocolData.public_key.hex()
+        if node.state.public_key and node.state.public_key != public_key and master.pki is not None:
+            # Key changed, drop the shared secret derived from the old one
+            master.pki.invalidate(bytes.fromhex(node.state.public_key))
+        node.state.public_key = public_key
+        node.state.rssi = packet.rssi
+        node.state.snr = packet.snr
+        master.updateNode(node)
+
+    @classmethod
+    def handleText(cls, master, packet, timestamp):
+        node = cls.get(master.state.nodes, packet.sender)
+        msg = Message(packet.dest, packet.sender, packet.packetData.payload.decode("utf-8"), timestamp)
+        node.state.rssi = packet.rssi
+        node.state.snr = packet.snr
+        node.state.messages.append(msg)
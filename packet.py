@@ -1,16 +1,142 @@
 import base64
+import logging
 import meshtastic
 from meshtastic.protobuf import mesh_pb2, portnums_pb2
+from google.protobuf.message import DecodeError
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 import random
+import struct
+from collections import namedtuple
+from pki import PKI
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_KEY = "1PG7OiApB1nwvP+rz05pAQ=="
+DEFAULT_CHANNEL = "LongFast"
+
+class AESKey:
+    """
+    Channel keys, base64 decoded and validated once, only the CTR nonce changes per packet.
+    """
+    cache = {}
+
+    @classmethod
+    def get(cls, aesKey):
+        key = cls.cache.get(aesKey)
+        if key is None:
+            raw = base64.b64decode(aesKey.encode("ascii") if type(aesKey) is str else aesKey)
+            if len(raw) == 1:
+                # Simple PSK index, 1 is the default key and the others bump its last byte
+                if raw[0] == 0:
+                    raise Exception("MeshPacket: Unencrypted channels are not supported")
+                default = base64.b64decode(DEFAULT_KEY)
+                raw = default[:-1] + bytes([(default[-1] + raw[0] - 1) & 0xFF])
+            if len(raw) not in (16, 32):
+                raise Exception(f"MeshPacket: Invalid AES key length {len(raw)}")
+            key = algorithms.AES(raw)
+            cls.cache[aesKey] = key
+        return key
+
+    @staticmethod
+    def nonce(packetID, sender):
+        return packetID + b'\x00\x00\x00\x00' + sender + b'\x00\x00\x00\x00'
+
+    @classmethod
+    def crypt(cls, aesKey, packetID, sender, data):
+        # CTR mode, encryption and decryption are the same operation
+        cipher = Cipher(cls.get(aesKey), modes.CTR(cls.nonce(packetID, sender)), backend=default_backend())
+        encryptor = cipher.encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+ChannelKey = namedtuple("ChannelKey", ["name", "psk", "hash"])
+
+class Channels:
+    """
+    Channel key table, indexed by the channel hash carried in the packet header
+    so only the keys that can match a frame are tried.
+    """
+    def __init__(self):
+        self.entries = []
+        self.byHash = {}
+
+    @staticmethod
+    def hash(name, psk):
+        h = 0
+        for b in name.encode("utf-8") + AESKey.get(psk).key:
+            h ^= b
+        return h
+
+    def add(self, name, psk=DEFAULT_KEY):
+        entry = ChannelKey(name, psk, Channels.hash(name, psk))
+        self.entries.append(entry)
+        self.byHash.setdefault(entry.hash, []).append(entry)
+        return entry
+
+    def get(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+        return None
+
+    def lookup(self, channelHash):
+        return self.byHash.get(channelHash, [])
+
+    @property
+    def primary(self):
+        return self.entries[0]
 
 class MeshPacket:
+    """
+    Only the 16-byte header is decoded by parse(), decryption and the protobuf
+    parses run on first access to packetPayload/packetData/protocolData and are
+    kept, so duplicates and our own echoes are dropped almost for free.
+
+    A parsed packet keeps the received frame in raw, the encrypted payload is a
+    view into it and rebroadcast() only patches the header bytes of a copy.
+    """
+    # dest, sender, packetID, flags, channelHash, nextHop, relayNode
+    HEADER = struct.Struct("<4s4s4sBccc")
+    OFFSET_FLAGS = 12
+    OFFSET_RELAY_NODE = 15
+
+    __slots__ = (
+        "raw", "aesKey", "channel", "candidates", "pki", "pkiKey", "ports",
+        "dest", "sender", "packetID", "flags",
+        "hopLimit", "wantAck", "viaMQTT", "hopStart",
+        "channelHash", "nextHop", "relayNode",
+        "encryptedPayload", "rssi", "snr",
+        "_packetPayload", "_packetData", "_protocolData", "_dataParsed", "_protocolParsed",
+    )
+
+    def __init__(self):
+        self.raw = None
+        self.aesKey = None
+        self.channel = None
+        self.candidates = None
+        self.pki = None
+        self.pkiKey = None
+        self.ports = None
+        self.encryptedPayload = None
+        self._packetPayload = None
+        self._packetData = None
+        self._protocolData = None
+        self._dataParsed = False
+        self._protocolParsed = False
+
     @classmethod
-    def new(cls, dest, sender, packet, aesKey):
+    def new(cls, dest, sender, packet, aesKey, channelHash=b"\x08", pkiKey=None):
+        """
+        With pkiKey (from PKI.keyFor) the packet is a PKI direct message and aesKey is ignored
+        """
         self = cls()
+        if isinstance(aesKey, ChannelKey):
+            self.channel = aesKey.name
+            channelHash = bytes([aesKey.hash])
+            aesKey = aesKey.psk
+        if pkiKey is not None:
+            self.pkiKey = pkiKey
+            channelHash = b"\x00"
         self.aesKey = aesKey
         self.dest = dest
         self.sender = sender
@@ -20,7 +146,7 @@ class MeshPacket:
         self.wantAck = 0
         self.viaMQTT = 0
         self.hopStart = 3
-        self.channelHash = b"\x08"
+        self.channelHash = channelHash
         self.nextHop = b"\x00"
         self.relayNode = b"\x00"
         self.rssi = None
@@ -30,113 +156,195 @@ class MeshPacket:
     @property
     def bytes(self):
         self.packetPayload = self.packetData.SerializeToString()
-        nonce = self.packetID + b'\x00\x00\x00\x00' + self.sender + b'\x00\x00\x00\x00'
-        cipher = Cipher(algorithms.AES(base64.b64decode(self.aesKey.encode("ascii"))), modes.CTR(nonce), backend=default_backend())
-        encryptor = cipher.encryptor()
-        self.encryptedPayload = encryptor.update(self.packetPayload) + encryptor.finalize()
+        if self.pkiKey is not None:
+            self.encryptedPayload = PKI.encrypt(self.pkiKey, self.packetID, self.sender, self.packetPayload)
+        else:
+            self.encryptedPayload = AESKey.crypt(self.aesKey, self.packetID, self.sender, self.packetPayload)
         self.flags = ((self.hopLimit & 0b111) << 5) | ((self.viaMQTT & 0b1) << 4) | ((self.wantAck & 0b1) << 3) | (self.hopLimit & 0b111)
         return self.dest + self.sender + self.packetID + bytes([self.flags]) + self.channelHash + self.nextHop + self.relayNode + self.encryptedPayload
 
     @classmethod
-    def parse(cls, data, aesKey):
+    def parse(cls, data, aesKey, pki=None, ports=None):
+        """
+        aesKey is either a single key or a Channels table, in which case
+        only the channels matching the header's channel hash are tried.
+        Direct messages to pki.addr with channel hash 0 are decrypted with PKI.
+        With ports, protocolData is only parsed for subscribed ports.
+        """
         self = cls()
-        self.aesKey = aesKey
-        self.dest = data[0:4]
-        self.sender = data[4:8]
-        self.packetID = data[8:12]
-        self.flags = data[12:13][0]
+        self.raw = data
+        self.ports = ports
+        self.dest, self.sender, self.packetID, self.flags, self.channelHash, self.nextHop, self.relayNode = MeshPacket.HEADER.unpack_from(data)
+        if pki is not None and self.channelHash[0] == 0 and self.dest == pki.addr:
+            # The shared key is looked up on first access to the payload
+            self.pki = pki
+        elif isinstance(aesKey, Channels):
+            self.candidates = aesKey.lookup(self.channelHash[0])
+            if len(self.candidates) == 1:
+                self.channel = self.candidates[0].name
+                self.aesKey = self.candidates[0].psk
+        else:
+            self.aesKey = aesKey
         self.hopLimit = self.flags & 0b111
         self.wantAck = (self.flags >> 3) & 0b1
         self.viaMQTT = (self.flags >> 4) & 0b1
         self.hopStart = (self.flags >> 5) & 0b111
-        self.channelHash = data[13:14]
-        self.nextHop = data[14:15]
-        self.relayNode = data[15:16]
-        self.encryptedPayload = data[16:len(data)]
-
-        # Decrypt the data
-        nonce = self.packetID + b'\x00\x00\x00\x00' + self.sender + b'\x00\x00\x00\x00'
-        cipher = Cipher(algorithms.AES(base64.b64decode(aesKey.encode("ascii"))), modes.CTR(nonce), backend=default_backend())
-        decryptor = cipher.decryptor()
-        self.packetPayload = decryptor.update(self.encryptedPayload) + decryptor.finalize()
-
-        self.packetData = mesh_pb2.Data()
-        try:
-            self.packetData.ParseFromString(self.packetPayload)
-        except:
-            self.packetData = None
-
-        self.protocolData = None
-        if self.packetData is not None:
-            handler = meshtastic.protocols.get(self.packetData.portnum)
-            pb = None
-            if handler and handler.protobufFactory:
-                pb = handler.protobufFactory()
-            else:
-                pb = None
+        self.encryptedPayload = memoryview(data)[MeshPacket.HEADER.size:]
+        self.rssi = None
+        self.snr = None
+        return self
+
+    @property
+    def packetPayload(self):
+        if self._packetPayload is None and self.pki is not None:
+            if self.pkiKey is None:
+                self.pkiKey = self.pki.keyFor(self.sender)
+            if self.pkiKey is not None:
+                self._packetPayload = PKI.decrypt(self.pkiKey, self.packetID, self.sender, self.encryptedPayload)
+            return self._packetPayload
+        if self._packetPayload is None and self.aesKey is None and self.candidates:
+            # Colliding channel hashes, the right key is the one that parses
+            self.packetData
+        if self._packetPayload is None and self.aesKey is not None and self.encryptedPayload is not None:
+            # Decrypt the data
+            self._packetPayload = AESKey.crypt(self.aesKey, self.packetID, self.sender, self.encryptedPayload)
+        return self._packetPayload
 
-            if pb is not None:
+    @packetPayload.setter
+    def packetPayload(self, value):
+        self._packetPayload = value
+
+    @property
+    def packetData(self):
+        if not self._dataParsed and self.aesKey is None and self.candidates:
+            self._dataParsed = True
+            for candidate in self.candidates:
+                self.aesKey = candidate.psk
+                self._packetPayload = None
+                self._packetData = mesh_pb2.Data()
                 try:
-                    pb.ParseFromString(self.packetData.payload)
-                    self.protocolData = pb
+                    self._packetData.ParseFromString(self.packetPayload)
+                    self.channel = candidate.name
+                    break
                 except:
-                    self.protocolData = None
-                    import traceback
-                    traceback.print_exc()
+                    self._packetData = None
+            else:
+                self.aesKey = None
+                self._packetPayload = None
+        if not self._dataParsed:
+            self._dataParsed = True
+            if self.packetPayload is None:
+                # Not one of our channels
+                return None
+            self._packetData = mesh_pb2.Data()
+            try:
+                self._packetData.ParseFromString(self.packetPayload)
+            except:
+                self._packetData = None
+        return self._packetData
 
-        return self
+    @packetData.setter
+    def packetData(self, value):
+        self._packetData = value
+        self._dataParsed = True
+        self._protocolData = None
+        self._protocolParsed = False
+
+    @property
+    def protocolData(self):
+        if not self._protocolParsed:
+            self._protocolParsed = True
+            self._protocolData = None
+            if self.packetData is not None:
+                if self.ports is not None:
+                    factory = self.ports.factory(self.packetData.portnum)
+                else:
+                    factory = MeshPacket.protocolFactory(self.packetData.portnum)
+                self._protocolData = MeshPacket.decodeProtocol(factory, self.packetData)
+        return self._protocolData
+
+    @staticmethod
+    def protocolFactory(portnum):
+        handler = meshtastic.protocols.get(portnum)
+        return handler.protobufFactory if handler else None
 
-    def rebroadcast(self):
+    @staticmethod
+    def decodeProtocol(factory, packetData):
+        """
+        Return:
+            packetData.payload parsed with factory
+            None if there is no factory or the payload does not parse
+        """
+        if not factory:
+            return None
+        pb = factory()
+        try:
+            pb.ParseFromString(packetData.payload)
+            return pb
+        except DecodeError:
+            logger.debug("undecodable port %s payload", packetData.portnum, exc_info=True)
+            return None
+
+    def rebroadcast(self, relayNode=None):
+        """
+        Return:
+            the frame to relay, with hopLimit decremented and relayNode set if given
+            None if the hop limit is exhausted
+        """
         if self.hopLimit == 0:
             return None
-        else:
-            flags = self.hopLimit << 5
-            flags |= self.viaMQTT << 4
-            flags |= self.wantAck << 3
-            flags |= (self.hopLimit - 1)
-            return self.dest + self.sender + self.packetID + bytes([flags]) + self.channelHash + self.nextHop + self.relayNode + self.encryptedPayload
-
-    def print(self):
-        print("Dest:", self.dest.hex())
-        print("Sender:", self.sender.hex())
-        print("Packet ID:", self.packetID.hex())
-        # print("Flags:", self.flags)
-        print("Hop Limit:", self.hopLimit)
-        print("Want Ack:", self.wantAck)
-        print("Via MQTT:", self.viaMQTT)
-        print("Hop Start:", self.hopStart)
-        print("Channel Hash:", self.channelHash)
-        print("Next Hop:", self.nextHop)
-        print("Relay Node:", self.relayNode)
-        print("Encrypted Payload:", self.encryptedPayload)
-        print("Packet Payload:", self.packetPayload)
+        frame = bytearray(self.raw if self.raw is not None else self.bytes)
+        frame[MeshPacket.OFFSET_FLAGS] = (self.flags & ~0b111) | (self.hopLimit - 1)
+        if relayNode is not None:
+            frame[MeshPacket.OFFSET_RELAY_NODE] = relayNode[0]
+        return frame
 
-        if self.packetData:
-            print(f"Packet Data: {type(self.packetData)} {{")
-            for descriptor in self.packetData.DESCRIPTOR.fields:
-                value = getattr(self.packetData, descriptor.name)
-                if descriptor.type == descriptor.TYPE_ENUM:
-                    try:
-                        value = descriptor.enum_type.values[value].name
-                    except:
-                        value = f"Unknown ({value})"
-                print(f"    {descriptor.name}: {value}")
-            print("}")
+    @staticmethod
+    def describeMessage(title, message):
+        lines = [f"{title}: {type(message)} {{"]
+        for descriptor in message.DESCRIPTOR.fields:
+            value = getattr(message, descriptor.name)
+            if descriptor.type == descriptor.TYPE_ENUM:
+                try:
+                    value = descriptor.enum_type.values[value].name
+                except:
+                    value = f"Unknown ({value})"
+            lines.append(f"    {descriptor.name}: {value}")
+        lines.append("}")
+        return lines
+
+    def describe(self):
+        """
+        Return:
+            the full dump of the packet, decrypting and parsing it if not done yet
+        """
+        lines = [
+            f"Dest: {self.dest.hex()}",
+            f"Sender: {self.sender.hex()}",
+            f"Packet ID: {self.packetID.hex()}",
+            f"Hop Limit: {self.hopLimit}",
+            f"Want Ack: {self.wantAck}",
+            f"Via MQTT: {self.viaMQTT}",
+            f"Hop Start: {self.hopStart}",
+            f"Channel Hash: {self.channelHash} {'PKI' if self.pki or self.pkiKey else self.channel}",
+            f"Next Hop: {self.nextHop}",
+            f"Relay Node: {self.relayNode}",
+            f"Encrypted Payload: {bytes(self.encryptedPayload)}",
+            f"Packet Payload: {self.packetPayload}",
+        ]
 
         if self.packetData:
-            print("Protocol Payload:", self.packetData.payload)
-
-        if self.protocolData:
-            print(f"Protocol Data: {type(self.protocolData)} {{")
-            for descriptor in self.protocolData.DESCRIPTOR.fields:
-                value = getattr(self.protocolData, descriptor.name)
-                if descriptor.type == descriptor.TYPE_ENUM:
-                    try:
-                        value = descriptor.enum_type.values[value].name
-                    except:
-                        value = f"Unknown ({value})"
-                print(f"    {descriptor.name}: {value}")
-            print("}")
+            lines.extend(MeshPacket.describeMessage("Packet Data", self.packetData))
+            lines.append(f"Protocol Payload: {self.packetData.payload}")
+
+        protocolData = self.protocolData
+        if protocolData is None and self.packetData and self.ports is not None:
+            # Nothing subscribed to the port, still decoded for the dump
+            protocolData = MeshPacket.decodeProtocol(MeshPacket.protocolFactory(self.packetData.portnum), self.packetData)
+        if protocolData:
+            lines.extend(MeshPacket.describeMessage("Protocol Data", protocolData))
+
+        return "\n".join(lines)
 
 if __name__ == "__main__":
     # nodeinfo_app
@@ -144,8 +352,10 @@ if __name__ == "__main__":
 
     # text message
     data = b'\xff\xff\xff\xffp\x87\xa8\xbb\xe0\xa5/^c\x08\x00\x00\x01\x8ey=\x87\xfc4\xdc\xbd#'
+    logging.basicConfig(level=logging.INFO)
+
     data = MeshPacket.parse(data, DEFAULT_KEY)
-    data.print()
+    logger.info("%s", data.describe())
 
     packet = mesh_pb2.Data()
     packet.portnum = portnums_pb2.PortNum.TEXT_MESSAGE_APP
@@ -162,4 +372,32 @@ if __name__ == "__main__":
     print(data)
 
     parsed = MeshPacket.parse(data, DEFAULT_KEY)
-    parsed.print()
\ No newline at end of file
+    logger.info("%s", parsed.describe())
+
+    # Throughput
+    import time
+    N = 20000
+    frames = [b'\xff\xff\xff\xffp\x87\xa8\xbb\xe0\xa5/^c\x08\x00\x00\x01\x8ey=\x87\xfc4\xdc\xbd#', data]
+    t0 = time.perf_counter()
+    for i in range(N):
+        MeshPacket.parse(frames[i % len(frames)], DEFAULT_KEY)
+    elapsed = time.perf_counter() - t0
+    print(f"parse (header only): {N/elapsed:.0f} packets/s")
+
+    t0 = time.perf_counter()
+    for i in range(N):
+        MeshPacket.parse(frames[i % len(frames)], DEFAULT_KEY).protocolData
+    elapsed = time.perf_counter() - t0
+    print(f"parse (full): {N/elapsed:.0f} packets/s")
+
+    t0 = time.perf_counter()
+    for i in range(N):
+        packet.bytes
+    elapsed = time.perf_counter() - t0
+    print(f"bytes: {N/elapsed:.0f} packets/s")
+
+    t0 = time.perf_counter()
+    for i in range(N):
+        parsed.rebroadcast(b"\x55")
+    elapsed = time.perf_counter() - t0
+    print(f"rebroadcast: {N/elapsed:.0f} packets/s")
\ No newline at end of file
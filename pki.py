@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESCCM
+
+class PKI:
+    """
+    Direct messages encrypted with X25519 + AES-CCM, as done by the firmware.
+
+    The on-air payload is ciphertext + 8-byte tag + 4-byte extra nonce, the key
+    is SHA-256 of the X25519 shared secret. Derived keys are kept per peer
+    public key in a bounded LRU, the key agreement runs once per peer.
+    """
+    TAG_SIZE = 8
+    EXTRA_NONCE_SIZE = 4
+    OVERHEAD = TAG_SIZE + EXTRA_NONCE_SIZE
+    CACHE_SIZE = 64
+
+    def __init__(self, privateKey, addr=None, lookup=None, cacheSize=CACHE_SIZE):
+        """
+        addr is our node address, as in packet headers
+        lookup(sender) returns the public key bytes of a node address, or None if unknown
+        """
+        self.addr = addr
+        self.privateKey = X25519PrivateKey.from_private_bytes(privateKey)
+        self.publicKey = self.privateKey.public_key().public_bytes_raw()
+        self.lookup = lookup
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def sharedKey(self, publicKey):
+        publicKey = bytes(publicKey)
+        with self.lock:
+            key = self.cache.get(publicKey)
+            if key is not None:
+                self.cache.move_to_end(publicKey)
+                self.hits += 1
+                return key
+            self.misses += 1
+        shared = self.privateKey.exchange(X25519PublicKey.from_public_bytes(publicKey))
+        key = AESCCM(hashlib.sha256(shared).digest(), tag_length=PKI.TAG_SIZE)
+        with self.lock:
+            self.cache[publicKey] = key
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        return key
+
+    def invalidate(self, publicKey=None):
+        with self.lock:
+            if publicKey is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(bytes(publicKey), None)
+
+    def keyFor(self, node):
+        if self.lookup is None:
+            return None
+        publicKey = self.lookup(node)
+        if not publicKey or len(publicKey) != 32:
+            return None
+        return self.sharedKey(publicKey)
+
+    @staticmethod
+    def nonce(packetID, sender, extraNonce):
+        # packet ID as a 64-bit little-endian number, extra nonce over its upper half, then the sender, 13 bytes for CCM
+        return bytes(packetID) + bytes(extraNonce) + bytes(sender) + b'\x00'
+
+    @staticmethod
+    def decrypt(key, packetID, sender, data):
+        """
+        Return:
+            the plaintext
+            None if data is too short or fails authentication
+        """
+        if len(data) <= PKI.OVERHEAD:
+            return None
+        data = bytes(data)
+        extraNonce = data[-PKI.EXTRA_NONCE_SIZE:]
+        try:
+            return key.decrypt(PKI.nonce(packetID, sender, extraNonce), data[:-PKI.EXTRA_NONCE_SIZE], None)
+        except InvalidTag:
+            return None
+
+    @staticmethod
+    def encrypt(key, packetID, sender, data):
+        extraNonce = os.urandom(PKI.EXTRA_NONCE_SIZE)
+        return key.encrypt(PKI.nonce(packetID, sender, extraNonce), bytes(data), None) + extraNonce
+
+if __name__ == "__main__":
+    import time
+
+    a = X25519PrivateKey.generate().private_bytes_raw()
+    b = X25519PrivateKey.generate().private_bytes_raw()
+    alice = PKI(a)
+    bob = PKI(b)
+
+    packetID = b"\x01\x02\x03\x04"
+    sender = b"\x66\x55\x66\x55"
+    data = PKI.encrypt(alice.sharedKey(bob.publicKey), packetID, sender, b"hello")
+    print(PKI.decrypt(bob.sharedKey(alice.publicKey), packetID, sender, data))
+
+    N = 2000
+    t0 = time.perf_counter()
+    for i in range(N):
+        bob.invalidate()
+        bob.sharedKey(alice.publicKey)
+    uncached = (time.perf_counter() - t0) / N
+    t0 = time.perf_counter()
+    for i in range(N):
+        bob.sharedKey(alice.publicKey)
+    cached = (time.perf_counter() - t0) / N
+    print(f"key agreement: {uncached*1e6:.1f} us, cached: {cached*1e6:.1f} us")
@@ -0,0 +1,42 @@
+import meshtastic
+
+class Ports:
+    """
+    portnum -> (protobuf factory, handlers), built once at startup.
+    App payloads are only parsed for ports with at least one handler,
+    handlers are called as handler(master, packet, timestamp).
+    """
+    def __init__(self):
+        self.table = {}
+        for portnum, protocol in meshtastic.protocols.items():
+            self.table[portnum] = (protocol.protobufFactory, [])
+
+    def subscribe(self, portnum, handler, factory=None):
+        prev, handlers = self.table.get(portnum, (None, []))
+        handlers.append(handler)
+        self.table[portnum] = (factory or prev, handlers)
+
+    def unsubscribe(self, portnum, handler):
+        entry = self.table.get(portnum)
+        if entry and handler in entry[1]:
+            entry[1].remove(handler)
+
+    def factory(self, portnum):
+        """
+        Return:
+            the protobuf factory of a subscribed port
+            None if nothing consumes the port or it has no protobuf payload
+        """
+        entry = self.table.get(portnum)
+        if entry is None or not entry[1]:
+            return None
+        return entry[0]
+
+    def dispatch(self, master, packet, timestamp):
+        if not packet.packetData:
+            return
+        entry = self.table.get(packet.packetData.portnum)
+        if entry is None:
+            return
+        for handler in entry[1]:
+            handler(master, packet, timestamp)
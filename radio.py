@@ -1,5 +1,9 @@
+import math
 from enum import IntEnum
 
+class TxTimeout(Exception):
+    pass
+
 class LoRa:
     class BandWidth(IntEnum):
         BW_7_8K = 0
@@ -42,8 +46,49 @@ class LoRa:
         SF_2048 = 11
         SF_4096 = 12
 
+    @staticmethod
+    def symbolTime(bw, sf):
+        return (1 << sf) / LoRa.BandWidthMap[bw]
+
+    @staticmethod
+    def lowDataRateOptimize(bw, sf):
+        # Mandated for symbols longer than 16 ms
+        return LoRa.symbolTime(bw, sf) > 16e-3
+
+    @staticmethod
+    def timeOnAir(length, bw, sf, cr, preambleLength=8, implicitHeader=False, crc=True, lowDataRateOpt=None):
+        """
+        Time on air in seconds of a payload of length bytes, per the SX126x/SX127x datasheets.
+        length can also be an iterable of lengths, a list of times is returned then.
+        """
+        symbolTime = LoRa.symbolTime(bw, sf)
+        if lowDataRateOpt is None:
+            lowDataRateOpt = LoRa.lowDataRateOptimize(bw, sf)
+        if sf < 7:
+            # SF5/SF6 (SX126x only) have a longer sync and no header offset
+            preamble = preambleLength + 6.25
+            offset = 16*bool(crc) - 4*sf + [20, 0][bool(implicitHeader)]
+        else:
+            preamble = preambleLength + 4.25
+            offset = 16*bool(crc) - 4*sf + 8 + [20, 0][bool(implicitHeader)]
+        divisor = 4 * (sf - 2*bool(lowDataRateOpt))
+        codeword = cr + 4
+
+        def toa(n):
+            return (preamble + 8 + math.ceil(max(8*n + offset, 0) / divisor) * codeword) * symbolTime
+
+        if isinstance(length, int):
+            return toa(length)
+        return [toa(n) for n in length]
+
 class Meshtastic:
     BROADCAST_ADDR = b"\xff\xff\xff\xff"
+    PREAMBLE_LENGTH = 16
+
+    @staticmethod
+    def timeOnAir(length, preset="LONG_FAST"):
+        presetCfg = Meshtastic.PRESETS[preset]
+        return LoRa.timeOnAir(length, presetCfg["bw"], presetCfg["sf"], presetCfg["cr"], Meshtastic.PREAMBLE_LENGTH)
 
     # https://meshtastic.org/docs/overview/radio-settings/#presets
     PRESETS = {
@@ -97,5 +142,22 @@ class Meshtastic:
             "endFreq": 925e6,
             "spacing": 0,
             "defaultSlot": 16,
+            # percent of airtime allowed per hour
+            "dutyCycle": 100,
         }
-    }
\ No newline at end of file
+    }
+
+if __name__ == "__main__":
+    import time
+
+    lengths = range(256)
+    t0 = time.perf_counter()
+    table = {preset: Meshtastic.timeOnAir(lengths, preset) for preset in Meshtastic.PRESETS}
+    elapsed = time.perf_counter() - t0
+
+    columns = [0, 16, 32, 64, 128, 192, 237, 255]
+    print(f"{'time on air (ms)':16s}", "".join(f"{n:>9d}" for n in columns))
+    for preset, toa in table.items():
+        print(f"{preset:16s}", "".join(f"{toa[n]*1000:9.1f}" for n in columns))
+    n = len(table) * len(lengths)
+    print(f"{n} lengths in {elapsed*1000:.2f} ms, {elapsed/n*1e6:.2f} us each")
@@ -0,0 +1,58 @@
+import random
+import threading
+
+class RttEstimator:
+    """
+    Per-destination round trip time to an ACK, SRTT/RTTVAR style (RFC 6298).
+
+    Until a destination has been sampled its RTT is seeded from the time one
+    hop takes (time on air plus relay hold) times the hops there and back.
+    Retransmissions back off exponentially from the RTO, with jitter so
+    retries from several nodes do not line up.
+    """
+    ALPHA = 1/8
+    BETA = 1/4
+    K = 4
+    MIN_RTO = 1.0
+    MAX_RTO = 120.0
+    JITTER = 0.25
+    DEFAULT_HOPS = 3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # node -> (srtt, rttvar)
+        self.peers = {}
+        self.hops = {}
+
+    def observeHops(self, node, hops):
+        if 0 <= hops <= 7:
+            self.hops[node] = hops
+
+    def rto(self, node, hopTime):
+        with self.lock:
+            peer = self.peers.get(node)
+        if peer is None:
+            # No sample yet, RTTVAR starts at half the RTT
+            srtt = 2 * max(self.hops.get(node, RttEstimator.DEFAULT_HOPS), 1) * hopTime
+            rttvar = srtt / 2
+        else:
+            srtt, rttvar = peer
+        return min(max(srtt + RttEstimator.K * rttvar, RttEstimator.MIN_RTO), RttEstimator.MAX_RTO)
+
+    def sample(self, node, rtt):
+        with self.lock:
+            peer = self.peers.get(node)
+            if peer is None:
+                self.peers[node] = (rtt, rtt / 2)
+            else:
+                srtt, rttvar = peer
+                rttvar = (1 - RttEstimator.BETA) * rttvar + RttEstimator.BETA * abs(srtt - rtt)
+                srtt = (1 - RttEstimator.ALPHA) * srtt + RttEstimator.ALPHA * rtt
+                self.peers[node] = (srtt, rttvar)
+
+    def timeout(self, node, attempt, hopTime):
+        """
+        Seconds to wait for an ACK after the attempt-th transmission, counting from 1
+        """
+        rto = self.rto(node, hopTime) * 2 ** (attempt - 1) * random.uniform(1, 1 + RttEstimator.JITTER)
+        return min(rto, RttEstimator.MAX_RTO)
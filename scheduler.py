@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import threading
+from enum import IntEnum
+
+class Priority(IntEnum):
+    ROUTING = 0
+    TEXT = 1
+    RELAY = 2
+    PERIODIC = 3
+
+class TxScheduler:
+    """
+    Pending transmissions, by due time then priority class.
+
+    Entries wait in a heap keyed by due time. Once due they move to a heap keyed
+    by (priority, due time), so among the frames that may go out now the most
+    important goes first and ties are served in due order. Push, pop and cancel
+    are O(log n); cancelled entries are dropped lazily when they surface.
+
+    Entries are objects with packetID, priority, lifetime and cancelled
+    attributes (PendingTX). An entry with a lifetime is dropped unsent once it
+    is more than lifetime seconds past due.
+
+    With an airtime ledger (AirtimeLedger), due entries of a priority it does
+    not allow stay ready until it does, or until their lifetime runs out.
+    """
+    def __init__(self, ledger=None):
+        self.ledger = ledger
+        self.waiting = []
+        self.ready = []
+        self.byID = {}
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.depth = {priority: 0 for priority in Priority}
+        self.garbage = 0
+        self.cancelled = 0
+        self.expired = 0
+        # Head entry the ledger last held back, so each frame is counted once
+        self.held = None
+
+    def push(self, pending, due):
+        """
+        An entry already queued for the same packetID is replaced
+        """
+        with self.lock:
+            prev = self.byID.get(pending.packetID)
+            if prev is pending:
+                raise Exception(f"TxScheduler: {pending.packetID.hex()} is already queued")
+            if prev is not None:
+                prev.cancelled = True
+                self.remove(prev)
+                self.garbage += 1
+            pending.cancelled = False
+            heapq.heappush(self.waiting, (due, next(self.seq), pending))
+            self.byID[pending.packetID] = pending
+            self.depth[pending.priority] += 1
+
+    def promote(self, now):
+        while self.waiting and self.waiting[0][0] <= now:
+            due, seq, pending = heapq.heappop(self.waiting)
+            if pending.cancelled:
+                self.garbage -= 1
+                continue
+            heapq.heappush(self.ready, (pending.priority, due, seq, pending))
+
+    def pop(self, now):
+        """
+        Return:
+            the most urgent entry due by now, removed from the scheduler
+            None if nothing is due
+        """
+        with self.lock:
+            self.promote(now)
+            while self.ready:
+                priority, due, seq, pending = self.ready[0]
+                if pending.cancelled:
+                    heapq.heappop(self.ready)
+                    self.garbage -= 1
+                    continue
+                if pending.lifetime is not None and now - due > pending.lifetime:
+                    heapq.heappop(self.ready)
+                    self.remove(pending)
+                    self.expired += 1
+                    continue
+                if self.ledger is not None and not self.ledger.allows(pending.priority, now):
+                    # Out of budget, everything behind it is of the same or lower priority
+                    if pending is not self.held:
+                        self.held = pending
+                        self.ledger.defer()
+                    return None
+                heapq.heappop(self.ready)
+                self.remove(pending)
+                return pending
+            return None
+
+    def remove(self, pending):
+        if self.byID.get(pending.packetID) is pending:
+            del self.byID[pending.packetID]
+        self.depth[pending.priority] -= 1
+
+    def cancel(self, packetID):
+        """
+        Return:
+            the cancelled entry, None if there was none for packetID
+        """
+        with self.lock:
+            pending = self.byID.get(packetID)
+            if pending is None:
+                return None
+            pending.cancelled = True
+            self.remove(pending)
+            self.cancelled += 1
+            self.garbage += 1
+            if self.garbage > 64 and self.garbage > len(self) // 2:
+                self.compact()
+            return pending
+
+    def compact(self):
+        self.waiting = [e for e in self.waiting if not e[2].cancelled]
+        self.ready = [e for e in self.ready if not e[3].cancelled]
+        heapq.heapify(self.waiting)
+        heapq.heapify(self.ready)
+        self.garbage = 0
+
+    def get(self, packetID):
+        return self.byID.get(packetID)
+
+    def __len__(self):
+        return len(self.waiting) + len(self.ready) - self.garbage
+
+    @property
+    def stats(self):
+        return {
+            "pending": len(self),
+            "ready": len(self.ready),
+            "depth": {priority.name: count for priority, count in self.depth.items()},
+            "cancelled": self.cancelled,
+            "expired": self.expired,
+        }
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+
+class SeenCache:
+    """
+    Recently handled (sender, packetID) pairs, for duplicate suppression.
+
+    Entries expire ttl seconds after they were last seen, and the least recently
+    seen ones are evicted beyond maxSize. Entries are kept in last-seen order,
+    so expired ones are always at the front.
+    """
+    def __init__(self, ttl=600, maxSize=1024):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def expire(self, now):
+        while self.entries:
+            key, last = next(iter(self.entries.items()))
+            if now - last < self.ttl:
+                break
+            self.entries.popitem(last=False)
+
+    def check(self, key, now=None):
+        """
+        Records key as seen.
+
+        Return:
+            True if key was already seen within ttl
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.expire(now)
+            hit = key in self.entries
+            self.entries[key] = now
+            if hit:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                while len(self.entries) > self.maxSize:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+            return hit
+
+    def add(self, key, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            self.expire(time.time())
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,39 @@
+import time
+
+class SpiTrace:
+    """
+    Wraps a pyftdi SpiPort and counts the transactions going through it,
+    used by the drivers' bench actions.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.reset()
+
+    def reset(self):
+        self.transactions = 0
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.elapsed = 0
+
+    def exchange(self, out=b'', readlen=0, *args, **kwargs):
+        t0 = time.perf_counter()
+        ret = self.port.exchange(out, readlen, *args, **kwargs)
+        self.elapsed += time.perf_counter() - t0
+        self.transactions += 1
+        self.bytesOut += len(out)
+        self.bytesIn += len(ret)
+        return ret
+
+    def write(self, out, *args, **kwargs):
+        t0 = time.perf_counter()
+        ret = self.port.write(out, *args, **kwargs)
+        self.elapsed += time.perf_counter() - t0
+        self.transactions += 1
+        self.bytesOut += len(out)
+        return ret
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def __str__(self):
+        return f"{self.transactions} transactions, {self.bytesOut} bytes out, {self.bytesIn} bytes in, {self.elapsed*1000:.2f} ms"
@@ -1,10 +1,17 @@
+import math
+import logging
 import time
+from contextlib import contextmanager
 from enum import IntEnum
-from radio import LoRa, Meshtastic
+from radio import LoRa, Meshtastic, TxTimeout
 from common import bool_from_str, comp2
+from transceiver import Transceiver
 
-class SX126x:
+logger = logging.getLogger(__name__)
+
+class SX126x(Transceiver):
     GPIO_RST = 1<<4
+    GPIO_BUSY = 1<<5 # optional, AD5 is GPIOL1 which the MPSSE engine can wait on
 
     Fxosc = 32e6
     Fclk = 10e6
@@ -63,41 +70,84 @@ class SX126x:
     CMD_SET_PA_CONFIG = 0x95
     CMD_SET_REGULATOR_MODE = 0x96
     CMD_GET_STATUS = 0xC0
+    CMD_SET_CAD = 0xC5
+    CMD_SET_CAD_PARAMS = 0x88
+
+    CAD_ON_1_SYMB = 0x00
+    CAD_ON_2_SYMB = 0x01
+    CAD_ON_4_SYMB = 0x02
+    CAD_ON_8_SYMB = 0x03
+    CAD_ON_16_SYMB = 0x04
+    CAD_ONLY = 0x00
+
+    # cadSymbolNum, cadDetPeak, cadDetMin per spreading factor, from AN1200.48
+    CAD_PARAMS = {
+        LoRa.SpreadingFactor.SF_32: (CAD_ON_2_SYMB, 22, 10),
+        LoRa.SpreadingFactor.SF_64: (CAD_ON_2_SYMB, 22, 10),
+        LoRa.SpreadingFactor.SF_128: (CAD_ON_2_SYMB, 22, 10),
+        LoRa.SpreadingFactor.SF_256: (CAD_ON_2_SYMB, 22, 10),
+        LoRa.SpreadingFactor.SF_512: (CAD_ON_4_SYMB, 23, 10),
+        LoRa.SpreadingFactor.SF_1024: (CAD_ON_4_SYMB, 24, 10),
+        LoRa.SpreadingFactor.SF_2048: (CAD_ON_4_SYMB, 25, 10),
+        LoRa.SpreadingFactor.SF_4096: (CAD_ON_8_SYMB, 28, 10),
+    }
 
     PACKET_TYPE_LORA = 0x01
 
+    # Worst-case BUSY time after a command, used for pacing when BUSY is not wired
+    BUSY_TIME = {
+        CMD_SET_STANDBY: 0.001,
+        CMD_SET_RX: 0.001,
+        CMD_SET_TX: 0.001,
+        CMD_SET_SLEEP: 0.001,
+        CMD_SET_PACKET_TYPE: 0.001,
+        CMD_SET_REGULATOR_MODE: 0.001,
+        CMD_SET_CAD: 0.001,
+    }
+    BUSY_TIME_DEFAULT = 0.0001
+
     CFG_DIO2_AS_RF_SWITCH_CTRL = "dio2_as_rf_switch_ctrl"
     CFG_REGULATOR_MODE = "regulator_mode"
+    CFG_BATCH = "batch"
+    CFG_BUSY_PIN = "busy_pin"
 
-    def __init__(self, device=None, params=None):
-        from pyftdi.usbtools import UsbTools
-        from pyftdi.ftdi import Ftdi
-        from pyftdi.spi import SpiController
+    # Shadow key of the operating mode, tracked through the SetStandby/SetRx/SetTx commands
+    SHADOW_MODE = "mode"
 
-        if device is None or device == "-":
-            device = 'ftdi://::/1'
-        elif type(device) == int:
-            devs = [f'ftdi://{d[0].vid}:{d[0].pid}:{d[0].bus}:{d[0].address}/1' for d in Ftdi.list_devices()]
-            print(devs)
-            device = devs[device]
+    def __init__(self, device=None, params=None, spi=None):
+        super().__init__()
 
         if params is None:
             params = {}
         params = dict(params)
         params[SX126x.CFG_DIO2_AS_RF_SWITCH_CTRL] = bool_from_str( params.get(SX126x.CFG_DIO2_AS_RF_SWITCH_CTRL, "1"))
         params[SX126x.CFG_REGULATOR_MODE] = int(params.get(SX126x.CFG_REGULATOR_MODE, "0"), 0)
+        params[SX126x.CFG_BATCH] = bool_from_str(params.get(SX126x.CFG_BATCH, "0"))
+        params[SX126x.CFG_BUSY_PIN] = bool_from_str(params.get(SX126x.CFG_BUSY_PIN, "0"))
         self.params = params
-
-        self.spi = SpiController()
-        self.spi.configure(device)
+        self.queue = None
+        self.txStartLatency = None
+        self.rxBufferStatus = None
+
+        if spi is None:
+            from pyftdi.usbtools import UsbTools
+            from pyftdi.ftdi import Ftdi
+            from pyftdi.spi import SpiController
+
+            if device is None or device == "-":
+                device = 'ftdi://::/1'
+            elif type(device) == int:
+                devs = [f'ftdi://{d[0].vid}:{d[0].pid}:{d[0].bus}:{d[0].address}/1' for d in Ftdi.list_devices()]
+                logger.info("FTDI devices %s", devs)
+                device = devs[device]
+
+            spi = SpiController()
+            spi.configure(device)
+        self.spi = spi
         self.slave = self.spi.get_port(cs=0, freq=SX126x.Fclk, mode=0)
         self.gpio = self.spi.get_gpio()
 
-        self.gpio.set_direction(SX126x.GPIO_RST, SX126x.GPIO_RST)
-        self.gpio.write(0)
-        time.sleep(0.1)
-        self.gpio.write(SX126x.GPIO_RST)
-        time.sleep(0.2)
+        self.reset()
 
         version = self.readRegister(0x0320, 16)
         # print("version", version)
@@ -130,29 +180,107 @@ class SX126x:
         self.setCommand(SX126x.CMD_SET_PA_CONFIG, 0x04, 0x07, 0x00, 0x01)
         self.setCommand(SX126x.CMD_SET_TX_PARAMS, 0x16, 0x07)
 
+    def reset(self):
+        self.gpio.set_direction(SX126x.GPIO_RST, SX126x.GPIO_RST)
+        self.gpio.write(0)
+        time.sleep(0.1)
+        self.gpio.write(SX126x.GPIO_RST)
+        time.sleep(0.2)
+        self.invalidate()
+
+    def waitBusy(self, op):
+        if not self.params[SX126x.CFG_BUSY_PIN]:
+            time.sleep(SX126x.BUSY_TIME.get(op, SX126x.BUSY_TIME_DEFAULT))
+            return
+        if op == SX126x.CMD_SET_SLEEP:
+            # BUSY stays high until the next wake up
+            return
+        t0 = time.time()
+        while self.gpio.read() & SX126x.GPIO_BUSY:
+            if time.time() - t0 > 0.1:
+                raise Exception(f"SX126x: BUSY stuck high after command 0x{op:02X}")
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue the write-only commands issued in the block and send them in
+        a single USB transfer when it ends. Reads flush the queue first.
+        """
+        if self.queue is not None or not self.params[SX126x.CFG_BATCH]:
+            yield
+            return
+        self.queue = []
+        try:
+            yield
+        finally:
+            self.flush()
+            self.queue = None
+
+    def flush(self):
+        if not self.queue:
+            return
+        from pyftdi.ftdi import Ftdi
+
+        # Replay what SpiPort.write does for each command (mode 0 on /CS0),
+        # and clock dummy bytes with /CS high for the worst-case BUSY time
+        # after it. WAIT_ON_LOW has no timeout, a stuck BUSY would wedge the
+        # MPSSE engine, so BUSY is only checked once the batch is out.
+        queue, self.queue = self.queue, []
+        with self.spi._lock:
+            direction = self.spi.direction & 0xFF
+            idle = self.spi._cs_bits | self.spi._gpio_low
+            selected = idle & ~self.spi.CS_BIT
+            seq = bytearray()
+            for cmd in queue:
+                seq.extend((Ftdi.SET_BITS_LOW, selected, direction))
+                seq.extend((Ftdi.WRITE_BYTES_NVE_MSB, (len(cmd) - 1) & 0xFF, (len(cmd) - 1) >> 8))
+                seq.extend(cmd)
+                seq.extend((Ftdi.SET_BITS_LOW, idle, direction))
+                busy = SX126x.BUSY_TIME.get(cmd[0], SX126x.BUSY_TIME_DEFAULT)
+                n = math.ceil(busy * self.slave.frequency / 8)
+                seq.extend((Ftdi.CLK_BYTES_NO_DATA, (n - 1) & 0xFF, (n - 1) >> 8))
+            self.spi.ftdi.write_data(seq)
+        if self.params[SX126x.CFG_BUSY_PIN]:
+            self.waitBusy(queue[-1][0])
+
+    def write(self, cmd):
+        if self.queue is not None:
+            self.queue.append(cmd)
+            return
+        self.slave.write(cmd)
+        self.waitBusy(cmd[0])
+
     def getCommand(self, op, readlen):
+        self.flush()
         cmd = [op] + [0x0] * (readlen + 1)
         # print(f"Get command", [f"{x:02X}" for x in cmd])
         ret = self.slave.exchange(cmd, len(cmd), duplex=True)
         # print(f"Get 0x{op:02X} <<", [f"{x:02X}" for x in ret[1:]])
-        time.sleep(0.001)
+        self.waitBusy(op)
         return ret[2:] # skip 0:RFU, 1:Status
 
     def setCommand(self, op, *args):
         cmd = [op, *args]
         # print(f"Set command", [f"{x:02X}" for x in cmd])
         # ret = self.slave.exchange(cmd, len(cmd), duplex=True)
-        ret = self.slave.write(cmd)
-        time.sleep(0.001)
+        self.write(cmd)
+
+    def setCommandCached(self, op, *args):
+        if self.isShadowed(op, args):
+            return False
+        self.setCommand(op, *args)
+        self.shadow[op] = args
+        return True
 
     def readRegister(self, addr, readlen):
+        self.flush()
         addrh = (addr >> 8) & 0xFF
         addrl = addr & 0xFF
         cmd = [SX126x.CMD_READ_REGISTER, addrh, addrl] + [0x0] * (readlen+1)
         # print(f"Read register", [f"{x:02X}" for x in cmd])
         ret = self.slave.exchange(cmd, len(cmd), duplex=True)
         # print(f"Read register <<", [f"{x:02X}" for x in ret])
-        time.sleep(0.001)
+        self.waitBusy(SX126x.CMD_READ_REGISTER)
         return ret[4:]
 
     def writeRegister(self, addr, *data):
@@ -161,10 +289,18 @@ class SX126x:
         cmd = [SX126x.CMD_WRITE_REGISTER, addrh, addrl, *data]
         # print(f"Write register", [f"{x:02X}" for x in cmd])
         # ret = self.slave.exchange(cmd, len(cmd), duplex=True)
-        ret = self.slave.write(cmd)
-        time.sleep(0.001)
+        self.write(cmd)
+
+    def writeRegisterCached(self, addr, *data):
+        key = (SX126x.CMD_WRITE_REGISTER, addr)
+        if self.isShadowed(key, data):
+            return False
+        self.writeRegister(addr, *data)
+        self.shadow[key] = data
+        return True
 
     def readBuffer(self, addr, readlen):
+        self.flush()
         cmd = [SX126x.CMD_READ_BUFFER, addr] + [0x0] * (readlen + 1)
         # print(f"Read buffer", [f"{x:02X}" for x in cmd])
         ret = self.slave.exchange(cmd, len(cmd), duplex=True)
@@ -173,15 +309,15 @@ class SX126x:
 
     def writeBuffer(self, addr, data):
         cmd = [SX126x.CMD_WRITE_BUFFER, addr] + list(data)
-        ret = self.slave.write(cmd)
-        time.sleep(0.001)
+        self.write(cmd)
 
     def getStatus(self):
+        self.flush()
         cmd = [0xC0, 0x00]
         # print(f"Get status", [f"{x:02X}" for x in cmd])
         ret = self.slave.exchange(cmd, len(cmd), duplex=True)
         # print("Status", f"{ret[1]:08b}")
-        time.sleep(0.001)
+        self.waitBusy(SX126x.CMD_GET_STATUS)
         return ret[1]
 
     def wait_rx(self, timeout=3):
@@ -200,38 +336,50 @@ class SX126x:
 
             if irq & SX126x.IRQ.TIMEOUT:
                 # Workaround: 15.3 Implicit Header Mode Timeout Behavior
+                self.invalidate(SX126x.SHADOW_MODE)
                 self.writeRegister(0x0920, 0x00)
                 value = self.readRegister(0x0944, 1)
                 value = value[0] | 0x02
                 self.writeRegister(0x0944, value)
 
                 self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, 0xFF, 0xFF)
+                self.receive()
                 return  None
-            if irq & SX126x.IRQ.CRC_ERROR:
+            if irq & (SX126x.IRQ.CRC_ERROR | SX126x.IRQ.RX_DONE):
+                # Still in RX, the next frame may land before read_payload(), so take its offset now
+                self.rxBufferStatus = self.getCommand(SX126x.CMD_GET_RX_BUFFER_STATUS, 2)
                 self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, 0xFF, 0xFF)
-                return  False
-            if irq & SX126x.IRQ.RX_DONE:
+                return  not irq & SX126x.IRQ.CRC_ERROR
+            if irq & SX126x.IRQ.HEADER_ERROR:
                 self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, 0xFF, 0xFF)
-                return  True
+                irq = 0
 
-            time.sleep(0.1)
+            interval = self.rxPollInterval(bool(irq & SX126x.IRQ.PREAMBLE_DETECTED), bool(irq & SX126x.IRQ.HEADER_VALID))
+            if interval is None:
+                self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, 0x00, SX126x.IRQ.PREAMBLE_DETECTED | SX126x.IRQ.HEADER_VALID)
+                continue
+            time.sleep(interval)
         return None
 
     def setFrequency(self, freq):
         frf = int(freq * (2**25) / SX126x.Fxosc)
         frf = ((frf >> 24) & 0xFF), ((frf >> 16) & 0xFF), ((frf >> 8) & 0xFF), (frf & 0xFF)
         # print("FRF", freq, frf)
-        self.setCommand(SX126x.CMD_SET_RF_FREQUENCY, frf[0], frf[1], frf[2], frf[3])
+        self.setCommandCached(SX126x.CMD_SET_RF_FREQUENCY, frf[0], frf[1], frf[2], frf[3])
 
     def setSync(self, value = 0x12):
         self.sync = value & 0xFF
         msb = (self.sync & 0xF0) | 4
         lsb = ((self.sync << 4) & 0xF0) | 4
+        key = (SX126x.CMD_WRITE_REGISTER, 0x0740)
+        if self.isShadowed(key, (msb, lsb)):
+            return
         self.writeRegister(0x0740, msb, lsb)
 
         sync = self.readRegister(0x0740, 2)
         if sync != bytes([msb, lsb]):
             raise Exception("Sync word mismatch")
+        self.shadow[key] = (msb, lsb)
 
     def setBandwidth(self, bw: LoRa.BandWidth):
         self.bw = bw
@@ -258,9 +406,7 @@ class SX126x:
         self.preambleLength = length
 
     def setModulationParams(self):
-        bw_khz = LoRa.BandWidthMap[self.bw] / 1000
-        symbolLength = (1 << self.sf) / bw_khz
-        lowDataRateOpt = 1 if symbolLength > 16 else 0
+        lowDataRateOpt = [0, 1][LoRa.lowDataRateOptimize(self.bw, self.sf)]
         bw = {
             LoRa.BandWidth.BW_7_8K: 0x0,
             LoRa.BandWidth.BW_10_4K: 0x8,
@@ -273,31 +419,53 @@ class SX126x:
             LoRa.BandWidth.BW_250K: 0x5,
             LoRa.BandWidth.BW_500K: 0x6,
         }.get(self.bw)
-        self.setCommand(SX126x.CMD_SET_MODULATION_PARAMS, self.sf, bw, self.cr, lowDataRateOpt)
+        return self.setCommandCached(SX126x.CMD_SET_MODULATION_PARAMS, self.sf, bw, self.cr, lowDataRateOpt)
 
     def standby(self):
+        if self.isShadowed(SX126x.SHADOW_MODE, SX126x.CMD_SET_STANDBY):
+            return
         self.setCommand(SX126x.CMD_SET_STANDBY, SX126x.StdbyConfig.RC)
+        self.shadow[SX126x.SHADOW_MODE] = SX126x.CMD_SET_STANDBY
+
+    def sleep(self):
+        # Cold start, the configuration is lost
+        self.setCommand(SX126x.CMD_SET_SLEEP, 0x00)
+        self.invalidate()
 
     def receive(self):
-        self.setModulationParams()
-        self.setCommand(SX126x.CMD_SET_PACKET_PARAMS,
-                          (self.preambleLength >> 8) & 0xFF,
-                          self.preambleLength & 0xFF,
-                          [0, 1][self.implicitHeader],
-                          0xFF,
-                          [0, 1][self.crc],
-                          0x00 # Standard IQ
-                        )
-
-        # Clear IRQ status
-        self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, 0xFF, 0xFF)
-
-        # Start receive mode with no timeout, continuous mode
-        self.setCommand(SX126x.CMD_SET_RX, 0xFF, 0xFF, 0xFF)
+        self.continuous = True
+        with self.batch():
+            changed = self.setModulationParams()
+            changed |= self.setCommandCached(SX126x.CMD_SET_PACKET_PARAMS,
+                              (self.preambleLength >> 8) & 0xFF,
+                              self.preambleLength & 0xFF,
+                              [0, 1][self.implicitHeader],
+                              0xFF,
+                              [0, 1][self.crc],
+                              0x00 # Standard IQ
+                            )
+
+            # Parameters changed under SetRx, it has to be issued again
+            if changed:
+                self.invalidate(SX126x.SHADOW_MODE)
+            # Already listening with the same parameters
+            if self.isShadowed(SX126x.SHADOW_MODE, SX126x.CMD_SET_RX):
+                return
+
+            # Clear IRQ status
+            self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, 0xFF, 0xFF)
+
+            # Start receive mode with no timeout, continuous mode
+            self.setCommand(SX126x.CMD_SET_RX, 0xFF, 0xFF, 0xFF)
+            self.shadow[SX126x.SHADOW_MODE] = SX126x.CMD_SET_RX
 
     def read_payload(self):
         # Get packet status
-        pkt_len, rx_buf_addr = self.getCommand(SX126x.CMD_GET_RX_BUFFER_STATUS, 2)
+        if self.rxBufferStatus is not None:
+            pkt_len, rx_buf_addr = self.rxBufferStatus
+            self.rxBufferStatus = None
+        else:
+            pkt_len, rx_buf_addr = self.getCommand(SX126x.CMD_GET_RX_BUFFER_STATUS, 2)
 
         # Read the received packet
         rx_data = self.readBuffer(rx_buf_addr, pkt_len)
@@ -308,47 +476,120 @@ class SX126x:
         rssiPkt = -status[0]/2
         snrPkt = comp2(status[1])/4
         signalRssiPkt = -status[2]/2
-        print(rssiPkt, snrPkt)
+        logger.debug("rssi=%s snr=%s", rssiPkt, snrPkt)
         return rssiPkt, snrPkt
 
-    def send(self, data):
-        print("Send", data, len(data))
-        self.standby()
-
-        # Workaround: 15.1 Modulation Quality with 500 kHz LoRa® Bandwidth
-        if self.bw == LoRa.BandWidth.BW_500K:
-            value = self.readRegister(0x0889, 1)
-            value = value[0] & 0xFB
-            self.writeRegister(0x0889, value)
-
-        self.setCommand(SX126x.CMD_SET_PACKET_PARAMS,
-                          (self.preambleLength >> 8) & 0xFF,
-                          self.preambleLength & 0xFF,
-                          [0, 1][self.implicitHeader],
-                          len(data),
-                          [0, 1][self.crc],
-                          0x00 # Standard IQ
-                        )
-
-        self.setCommand(SX126x.CMD_SET_BUFFER_BASE_ADDR, 0x00, 0x00)
-        self.writeBuffer(0x00, data)
-        self.setCommand(SX126x.CMD_SET_TX, 0x00, 0x00, 0x00)
+    def cad(self):
+        """
+        Return:
+            True if LoRa activity was detected on the channel
+        """
+        if self.isShadowed(SX126x.SHADOW_MODE, SX126x.CMD_SET_RX):
+            # A frame being received is activity already, no need to leave RX for that
+            irq_status = self.getCommand(SX126x.CMD_GET_IRQ_STATUS, 2)
+            irq = (irq_status[0] << 8) | irq_status[1]
+            if irq & (SX126x.IRQ.PREAMBLE_DETECTED | SX126x.IRQ.HEADER_VALID):
+                return True
+
+        symbolNum, detPeak, detMin = SX126x.CAD_PARAMS[self.sf]
+        mask = SX126x.IRQ.CAD_DETECTED | SX126x.IRQ.CAD_DONE
+        with self.batch():
+            self.standby()
+            self.setCommandCached(SX126x.CMD_SET_CAD_PARAMS, symbolNum, detPeak, detMin, SX126x.CAD_ONLY, 0x00, 0x00, 0x00)
+            self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, mask >> 8, mask & 0xFF)
+            self.setCommand(SX126x.CMD_SET_CAD)
+            self.shadow[SX126x.SHADOW_MODE] = SX126x.CMD_SET_CAD
+
+        duration = ((1 << symbolNum) + 1) * self.symbolTime()
+        t0 = time.time()
+        time.sleep(duration)
+        while True:
+            irq_status = self.getCommand(SX126x.CMD_GET_IRQ_STATUS, 2)
+            irq = (irq_status[0] << 8) | irq_status[1]
+            if irq & SX126x.IRQ.CAD_DONE:
+                break
+            if time.time() - t0 > duration * 2 + SX126x.TX_TIMEOUT_MARGIN:
+                # Call it busy rather than talk over something we could not check
+                self.invalidate(SX126x.SHADOW_MODE)
+                return True
+            time.sleep(self.symbolTime())
+        self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, mask >> 8, mask & 0xFF)
+        # CAD_ONLY goes back to STDBY_RC
+        self.shadow[SX126x.SHADOW_MODE] = SX126x.CMD_SET_STANDBY
+        return bool(irq & SX126x.IRQ.CAD_DETECTED)
 
+    def send(self, data):
+        """
+        Return:
+            True once transmitted
+            False if listen before talk found the channel busy, nothing was sent
+        """
+        logger.debug("send len=%d data=%s", len(data), data)
+        if self.channelBusy():
+            logger.info("channel busy")
+            if self.continuous:
+                self.receive()
+            return False
+
+        t0 = time.perf_counter()
+        with self.batch():
+            self.standby()
+
+            # Workaround: 15.1 Modulation Quality with 500 kHz LoRa® Bandwidth
+            if self.bw == LoRa.BandWidth.BW_500K:
+                value = self.readRegister(0x0889, 1)
+                value = value[0] & 0xFB
+                self.writeRegister(0x0889, value)
+
+            self.setCommandCached(SX126x.CMD_SET_PACKET_PARAMS,
+                              (self.preambleLength >> 8) & 0xFF,
+                              self.preambleLength & 0xFF,
+                              [0, 1][self.implicitHeader],
+                              len(data),
+                              [0, 1][self.crc],
+                              0x00 # Standard IQ
+                            )
+
+            self.setCommandCached(SX126x.CMD_SET_BUFFER_BASE_ADDR, 0x00, 0x00)
+            self.writeBuffer(0x00, data)
+            self.setCommand(SX126x.CMD_SET_TX, 0x00, 0x00, 0x00)
+            self.shadow[SX126x.SHADOW_MODE] = SX126x.CMD_SET_TX
+        self.txStartLatency = time.perf_counter() - t0
+
+        # Nothing to poll for until the frame is nearly out, then poll once per symbol
+        toa = self.timeOnAir(len(data))
+        t0 = time.time()
+        time.sleep(toa * 0.9)
+        interval = max(self.symbolTime(), 0.001)
         while True:
             irq_status = self.getCommand(SX126x.CMD_GET_IRQ_STATUS, 2)
             irq = (irq_status[0] << 8) | irq_status[1]
 
             if irq & SX126x.IRQ.TX_DONE:
                 self.setCommand(SX126x.CMD_CLEAR_IRQ_STATUS, 0xFF, 0xFF)
-                print("TX Done")
+                # Back to STDBY_RC once the packet is out
+                self.shadow[SX126x.SHADOW_MODE] = SX126x.CMD_SET_STANDBY
+                logger.debug("tx done")
                 break
+            if time.time() - t0 > toa * 2 + SX126x.TX_TIMEOUT_MARGIN:
+                self.invalidate(SX126x.SHADOW_MODE)
+                self.standby()
+                if self.continuous:
+                    self.receive()
+                raise TxTimeout(f"SX126x: TX not done after {time.time() - t0:.3f}s, expected {toa:.3f}s")
+            time.sleep(interval)
+
+        # Straight back to listening
+        if self.continuous:
+            self.receive()
+        return True
 
     def setMeshtastic(self, region="TW", preset="LONG_FAST", slot=None):
         regionCfg = Meshtastic.REGION.get(region, "TW")
         presetCfg = Meshtastic.PRESETS.get(preset, "LONG_FAST")
 
-        print("regionCfg", regionCfg)
-        print("presetCfg", presetCfg)
+        logger.info("region=%s %s", region, regionCfg)
+        logger.info("preset=%s %s", preset, presetCfg)
 
         if not slot:
             slot = regionCfg["defaultSlot"]
@@ -359,29 +600,32 @@ class SX126x:
         if freq > regionCfg["endFreq"]:
             raise Exception(f"Frequency {freq} out of range {regionCfg['startFreq']} - {regionCfg['endFreq']}")
 
-        self.standby()
-        self.setCommand(SX126x.CMD_SET_PACKET_TYPE, SX126x.PACKET_TYPE_LORA)
+        with self.batch():
+            self.standby()
+            self.setCommandCached(SX126x.CMD_SET_PACKET_TYPE, SX126x.PACKET_TYPE_LORA)
 
-        self.setBandwidth(presetCfg["bw"])
-        self.setSpreadingFactor(presetCfg["sf"])
-        self.setCodingRate(presetCfg["cr"])
+            self.setBandwidth(presetCfg["bw"])
+            self.setSpreadingFactor(presetCfg["sf"])
+            self.setCodingRate(presetCfg["cr"])
 
-        self.setImplicitHeader(False)
-        self.setTxContinuous(False)
-        self.setCrc(True)
-        self.setSync(0x2B)
-        self.setTxPower(True, 0)
-        self.setPreambleLength(16)
+            self.setImplicitHeader(False)
+            self.setTxContinuous(False)
+            self.setCrc(True)
+            self.setSync(0x2B)
+            self.setTxPower(True, 0)
+            self.setPreambleLength(16)
 
-        self.setFrequency(freq)
+            self.setFrequency(freq)
 
 if __name__ == "__main__":
     import sys
+    logging.basicConfig(level=logging.INFO)
     from datetime import datetime
 
     if len(sys.argv) < 3:
         print("Usage: sx126x.py deviceIdx rx")
         print("Usage: sx126x.py deviceIdx tx")
+        print("Usage: sx126x.py deviceIdx bench [frames]")
         sys.exit(1)
 
     device = sys.argv[1]
@@ -410,3 +654,17 @@ if __name__ == "__main__":
 
             data = sx.read_payload()
             print(datetime.now().strftime("[%Y-%m-%d %H:%M:%S]"), "OK" if ok else "NG", data)
+
+    if action == "bench":
+        # TX-start latency (send() call to SetTx on the wire) with and without batching
+        frames = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+        data = b'\xff\xff\xff\xffp\x87\xa8\xbb\xe0\xa5/^c\x08\x00\x00\x01\x8ey=\x87\xfc4\xdc\xbd#'
+        for batch in (False, True):
+            sx.params[SX126x.CFG_BATCH] = batch
+            latency = []
+            for i in range(frames):
+                # Leave RX in between so every send() starts from the same state
+                sx.receive()
+                sx.send(data)
+                latency.append(sx.txStartLatency)
+            print("batch" if batch else "no batch", f"TX start latency avg {sum(latency)/frames*1000:.2f} ms, max {max(latency)*1000:.2f} ms")
@@ -1,9 +1,13 @@
+import logging
 import time
 from enum import IntEnum
-from radio import LoRa, Meshtastic
-from common import comp2
+from radio import LoRa, Meshtastic, TxTimeout
+from common import bool_from_str, comp2
+from transceiver import Transceiver
 
-class SX127x:
+logger = logging.getLogger(__name__)
+
+class SX127x(Transceiver):
     GPIO_RST = 1<<4
 
     Fxosc = 32e6
@@ -19,10 +23,12 @@ class SX127x:
     REG_FIFORXCURRENTADDR = 0x10
     REG_IRQFLAGS = 0x12
     REG_RXNBBYTES = 0x13
+    REG_MODEMSTAT = 0x18
     REG_PKT_SNR_VALUE = 0x19
     REG_PKT_RSSI_VALUE = 0x1A
     REG_MODEMCONFIG1 = 0x1D
     REG_MODEMCONFIG2 = 0x1E
+    REG_MODEMCONFIG3 = 0x26
     REG_PREAMBLE = 0x20
     REG_PAYLOADLENGTH = 0x22
     REG_SYNCVALUE = 0x39
@@ -30,6 +36,13 @@ class SX127x:
 
     OPMODE_LONGRANGE = 0x80
 
+    # LNA gain set by the AGC, on at reset
+    MODEMCONFIG3_AGC_AUTO_ON = 1 << 2
+
+    MODEMSTAT_SIGNAL_DETECTED = 1 << 0
+    MODEMSTAT_SIGNAL_SYNCHRONIZED = 1 << 1
+    MODEMSTAT_HEADER_VALID = 1 << 3
+
     class IRQ(IntEnum):
         RX_TIMEOUT = 1 << 7
         RX_DONE = 1 << 6
@@ -50,28 +63,36 @@ class SX127x:
         LORA_RX_SINGLE = 6
         LORA_CAD = 7
 
-    def __init__(self, device=None):
-        from pyftdi.usbtools import UsbTools
-        from pyftdi.ftdi import Ftdi
-        from pyftdi.spi import SpiController
+    CFG_BURST = "burst"
+
+    def __init__(self, device=None, params=None, spi=None):
+        super().__init__()
+
+        if params is None:
+            params = {}
+        params = dict(params)
+        params[SX127x.CFG_BURST] = bool_from_str(params.get(SX127x.CFG_BURST, "1"))
+        self.params = params
+
+        if spi is None:
+            from pyftdi.usbtools import UsbTools
+            from pyftdi.ftdi import Ftdi
+            from pyftdi.spi import SpiController
 
-        if device is None:
-            device = 'ftdi://::/1'
-        elif type(device) == int:
-            devs = [f'ftdi://{d[0].vid}:{d[0].pid}:{d[0].bus}:{d[0].address}/1' for d in Ftdi.list_devices()]
-            print(devs)
-            device = devs[device]
+            if device is None:
+                device = 'ftdi://::/1'
+            elif type(device) == int:
+                devs = [f'ftdi://{d[0].vid}:{d[0].pid}:{d[0].bus}:{d[0].address}/1' for d in Ftdi.list_devices()]
+                logger.info("FTDI devices %s", devs)
+                device = devs[device]
 
-        self.spi = SpiController()
-        self.spi.configure(device)
+            spi = SpiController()
+            spi.configure(device)
+        self.spi = spi
         self.slave = self.spi.get_port(cs=0, freq=SX127x.Fclk, mode=0)
         self.gpio = self.spi.get_gpio()
 
-        self.gpio.set_direction(SX127x.GPIO_RST, SX127x.GPIO_RST)
-        self.gpio.write(0)
-        time.sleep(0.001)
-        self.gpio.write(SX127x.GPIO_RST)
-        time.sleep(0.005)
+        self.reset()
 
         version = self.read_version()
         if version != 0x12:
@@ -84,7 +105,23 @@ class SX127x:
         self.txCont = False
         self.crc = True
         self.sync = 0x12
-        self.slave.write([0x80 | SX127x.REG_OPMODE, SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_SLEEP])
+        self.preambleLength = 8
+        self.sleep()
+
+    def reset(self):
+        self.gpio.set_direction(SX127x.GPIO_RST, SX127x.GPIO_RST)
+        self.gpio.write(0)
+        time.sleep(0.001)
+        self.gpio.write(SX127x.GPIO_RST)
+        time.sleep(0.005)
+        self.invalidate()
+
+    def writeRegisterCached(self, addr, *data):
+        if self.isShadowed(addr, data):
+            return False
+        self.slave.write([0x80 | addr, *data])
+        self.shadow[addr] = data
+        return True
 
     def wait_rx(self, timeout=3):
         """
@@ -102,28 +139,33 @@ class SX127x:
             # print(f"IRQ: {irq:08b}")
             if irq & SX127x.IRQ.RX_TIMEOUT:
                 self.slave.write([0x80 | SX127x.REG_IRQFLAGS, SX127x.IRQ.RX_TIMEOUT])
+                self.invalidate(SX127x.REG_OPMODE)
+                self.receive()
                 return None
             if irq & SX127x.IRQ.PAYLOAD_CRC_ERROR:
-                self.slave.write([0x80 | SX127x.REG_IRQFLAGS, SX127x.IRQ.PAYLOAD_CRC_ERROR])
+                self.slave.write([0x80 | SX127x.REG_IRQFLAGS, SX127x.IRQ.PAYLOAD_CRC_ERROR | SX127x.IRQ.RX_DONE | SX127x.IRQ.VALID_HEADER])
                 return False
             if irq & SX127x.IRQ.RX_DONE:
-                self.slave.write([0x80 | SX127x.REG_IRQFLAGS, SX127x.IRQ.RX_DONE])
+                self.slave.write([0x80 | SX127x.REG_IRQFLAGS, SX127x.IRQ.RX_DONE | SX127x.IRQ.VALID_HEADER])
                 return True
 
-            time.sleep(0.1)
+            # LoRa mode has no preamble IRQ, only the valid header one
+            interval = self.rxPollInterval(header=bool(irq & SX127x.IRQ.VALID_HEADER))
+            if interval is None:
+                self.slave.write([0x80 | SX127x.REG_IRQFLAGS, SX127x.IRQ.VALID_HEADER])
+                continue
+            time.sleep(interval)
         return None
 
     def setFrequency(self, freq):
         frf = int(freq * (2**19) / SX127x.Fxosc)
         frf = ((frf >> 16) & 0xFF), ((frf >> 8) & 0xFF), (frf & 0xFF)
         # print("FRF", freq, frf)
-        self.slave.write([0x80 | SX127x.REG_FRF, frf[0]])
-        self.slave.write([0x80 | SX127x.REG_FRF+1, frf[1]])
-        self.slave.write([0x80 | SX127x.REG_FRF+2, frf[2]])
+        self.writeRegisterCached(SX127x.REG_FRF, *frf)
 
     def setSync(self, value = 0x12):
         self.sync = value & 0xFF
-        self.slave.write([0x80 | SX127x.REG_SYNCVALUE, self.sync])
+        self.writeRegisterCached(SX127x.REG_SYNCVALUE, self.sync)
 
     def setBandwidth(self, bw: LoRa.BandWidth):
         self.bw = bw
@@ -148,28 +190,44 @@ class SX127x:
     def setTxPower(self, boost: bool, level):
         if boost:
             level = min(max(level, 2), 17)
-            self.slave.write([0x80 | SX127x.REG_PACONFIG, 0x80 | (level - 2)])
+            self.writeRegisterCached(SX127x.REG_PACONFIG, 0x80 | (level - 2))
         else:
             level = min(max(level, 0), 14)
-            self.slave.write([0x80 | SX127x.REG_PACONFIG, 0x70 | level])
+            self.writeRegisterCached(SX127x.REG_PACONFIG, 0x70 | level)
 
     def setPreambleLength(self, length: int):
-        self.slave.write([0x80 | SX127x.REG_PREAMBLE, (length >> 8) & 0xFF, length & 0xFF])
+        self.preambleLength = length
+        self.writeRegisterCached(SX127x.REG_PREAMBLE, (length >> 8) & 0xFF, length & 0xFF)
 
     def setModemConfig1(self):
-        self.slave.write([0x80 | SX127x.REG_MODEMCONFIG1, (self.bw << 4) | (self.cr << 1) | [0,1][bool(self.implicitHeader)] ])
+        return self.writeRegisterCached(SX127x.REG_MODEMCONFIG1, (self.bw << 4) | (self.cr << 1) | [0,1][bool(self.implicitHeader)])
 
     def setModemConfig2(self):
-        self.slave.write([0x80 | SX127x.REG_MODEMCONFIG2, (self.sf << 4) | ([0,1][bool(self.txCont)] << 3) | ([0,1][bool(self.crc)] << 2) ])
+        return self.writeRegisterCached(SX127x.REG_MODEMCONFIG2, (self.sf << 4) | ([0,1][bool(self.txCont)] << 3) | ([0,1][bool(self.crc)] << 2))
+
+    def setModemConfig3(self):
+        return self.writeRegisterCached(SX127x.REG_MODEMCONFIG3, ([0,1][LoRa.lowDataRateOptimize(self.bw, self.sf)] << 3) | SX127x.MODEMCONFIG3_AGC_AUTO_ON)
 
     def standby(self):
-        self.slave.write([0x80 | SX127x.REG_OPMODE, SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_STANDBY])
+        self.writeRegisterCached(SX127x.REG_OPMODE, SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_STANDBY)
+
+    def sleep(self):
+        self.slave.write([0x80 | SX127x.REG_OPMODE, SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_SLEEP])
+        self.invalidate()
+        self.shadow[SX127x.REG_OPMODE] = (SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_SLEEP,)
 
     def receive(self):
-        self.setModemConfig1()
-        self.setModemConfig2()
+        self.continuous = True
+        changed = self.setModemConfig1()
+        changed |= self.setModemConfig2()
+        changed |= self.setModemConfig3()
+        target = SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_RX_CONTINUOUS
+        if changed:
+            self.invalidate(SX127x.REG_OPMODE)
+        # Already listening with the same configuration
+        if self.isShadowed(SX127x.REG_OPMODE, (target,)):
+            return
         while True:
-            target = SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_RX_CONTINUOUS
             self.slave.write([0x80 | SX127x.REG_OPMODE, target])
             r = None
             while not r:
@@ -177,6 +235,7 @@ class SX127x:
             if r[0] == target:
                 break
             time.sleep(0.001)
+        self.shadow[SX127x.REG_OPMODE] = (target,)
 
     def read_version(self):
         return self.slave.exchange([SX127x.REG_VERSION], 1)[0]
@@ -198,6 +257,10 @@ class SX127x:
 
         # print("packetLength", packetLength)
 
+        if self.params[SX127x.CFG_BURST]:
+            # FifoAddrPtr auto-increments, so the whole frame comes out in one transaction
+            return bytes(self.slave.exchange([SX127x.REG_FIFO], packetLength))
+
         payload = bytearray()
         for i in range(packetLength):
             payload.append(self.slave.exchange([SX127x.REG_FIFO], 1)[0])
@@ -212,17 +275,72 @@ class SX127x:
         pktRssi = -157 + pktRssi # XXX
         return pktRssi, pktSnr
 
+    def cad(self):
+        """
+        Return:
+            True if LoRa activity was detected on the channel
+        """
+        if self.isShadowed(SX127x.REG_OPMODE, (SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_RX_CONTINUOUS,)):
+            # A frame being received is activity already, no need to leave RX for that
+            stat = self.slave.exchange([SX127x.REG_MODEMSTAT], 1)[0]
+            if stat & (SX127x.MODEMSTAT_SIGNAL_DETECTED | SX127x.MODEMSTAT_SIGNAL_SYNCHRONIZED | SX127x.MODEMSTAT_HEADER_VALID):
+                return True
+
+        mask = SX127x.IRQ.CAD_DONE | SX127x.IRQ.CAD_DETECTED
+        self.standby()
+        self.slave.write([0x80 | SX127x.REG_IRQFLAGS, mask])
+        self.slave.write([0x80 | SX127x.REG_OPMODE, SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_CAD])
+        self.shadow[SX127x.REG_OPMODE] = (SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_CAD,)
+
+        # CAD listens for about two symbols
+        duration = 2 * self.symbolTime()
+        t0 = time.time()
+        time.sleep(duration)
+        while True:
+            irq = self.slave.exchange([SX127x.REG_IRQFLAGS], 1)[0]
+            if irq & SX127x.IRQ.CAD_DONE:
+                break
+            if time.time() - t0 > duration * 2 + SX127x.TX_TIMEOUT_MARGIN:
+                # Call it busy rather than talk over something we could not check
+                self.invalidate(SX127x.REG_OPMODE)
+                return True
+            time.sleep(self.symbolTime())
+        self.slave.write([0x80 | SX127x.REG_IRQFLAGS, mask])
+        # Back to standby once CAD is done
+        self.shadow[SX127x.REG_OPMODE] = (SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_STANDBY,)
+        return bool(irq & SX127x.IRQ.CAD_DETECTED)
+
     def send(self, data):
-        # print("Send", data, len(data))
-        self.slave.write([0x80 | SX127x.REG_OPMODE, SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_STANDBY])
+        """
+        Return:
+            True once transmitted
+            False if listen before talk found the channel busy, nothing was sent
+        """
+        logger.debug("send len=%d data=%s", len(data), data)
+        if self.channelBusy():
+            logger.info("channel busy")
+            if self.continuous:
+                self.receive()
+            return False
+
+        self.standby()
         fifoTxBaseAddr = self.slave.exchange([SX127x.REG_FIFOTXBASEADDR], 1)[0]
         # print("fifoTxBaseAddr", fifoTxBaseAddr)
         self.slave.write([0x80 | SX127x.REG_FIFOADDRPTR, fifoTxBaseAddr])
-        for i in range(len(data)):
-            self.slave.write([0x80 | SX127x.REG_FIFO, data[i]])
+        if self.params[SX127x.CFG_BURST]:
+            self.slave.write([0x80 | SX127x.REG_FIFO, *data])
+        else:
+            for i in range(len(data)):
+                self.slave.write([0x80 | SX127x.REG_FIFO, data[i]])
         self.slave.write([0x80 | SX127x.REG_PAYLOADLENGTH, len(data)])
         self.slave.write([0x80 | SX127x.REG_OPMODE, SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_TX])
+        self.shadow[SX127x.REG_OPMODE] = (SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_TX,)
 
+        # Nothing to poll for until the frame is nearly out, then poll once per symbol
+        toa = self.timeOnAir(len(data))
+        t0 = time.time()
+        time.sleep(toa * 0.9)
+        interval = max(self.symbolTime(), 0.001)
         while True:
             irq = None
             while not irq:
@@ -231,15 +349,28 @@ class SX127x:
             # print(f"IRQ: {irq:08b}")
             if irq & SX127x.IRQ.TX_DONE:
                 self.slave.write([0x80 | SX127x.REG_IRQFLAGS, SX127x.IRQ.TX_DONE])
-                print("TX Done")
+                # Back to standby once the packet is out
+                self.shadow[SX127x.REG_OPMODE] = (SX127x.OPMODE_LONGRANGE | SX127x.DeviceMode.LORA_STANDBY,)
+                logger.debug("tx done")
                 break
+            if time.time() - t0 > toa * 2 + SX127x.TX_TIMEOUT_MARGIN:
+                self.standby()
+                if self.continuous:
+                    self.receive()
+                raise TxTimeout(f"SX127x: TX not done after {time.time() - t0:.3f}s, expected {toa:.3f}s")
+            time.sleep(interval)
+
+        # Straight back to listening
+        if self.continuous:
+            self.receive()
+        return True
 
     def setMeshtastic(self, region="TW", preset="LONG_FAST", slot=None):
         regionCfg = Meshtastic.REGION.get(region, "TW")
         presetCfg = Meshtastic.PRESETS.get(preset, "LONG_FAST")
 
-        print("regionCfg", regionCfg)
-        print("presetCfg", presetCfg)
+        logger.info("region=%s %s", region, regionCfg)
+        logger.info("preset=%s %s", preset, presetCfg)
 
         if not slot:
             slot = regionCfg["defaultSlot"]
@@ -265,11 +396,13 @@ class SX127x:
 
 if __name__ == "__main__":
     import sys
+    logging.basicConfig(level=logging.INFO)
     from datetime import datetime
 
     if len(sys.argv) < 3:
         print("Usage: sx127x.py deviceIdx rx")
         print("Usage: sx127x.py deviceIdx tx")
+        print("Usage: sx127x.py deviceIdx bench [frames]")
         sys.exit(1)
 
     device = sys.argv[1]
@@ -298,3 +431,26 @@ if __name__ == "__main__":
 
             data = sx.read_payload()
             print(datetime.now().strftime("[%Y-%m-%d %H:%M:%S]"), "OK" if ok else "NG", data)
+
+    if action == "bench":
+        # Read every received frame twice, per-byte then burst, and compare the SPI cost
+        from spitrace import SpiTrace
+        frames = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+        sx.slave = SpiTrace(sx.slave)
+        sx.receive()
+        total = {False: [0, 0], True: [0, 0]}
+        n = 0
+        while n < frames:
+            ok = sx.wait_rx()
+            if ok is None:
+                continue
+            n += 1
+            for burst in (False, True):
+                sx.params[SX127x.CFG_BURST] = burst
+                sx.slave.reset()
+                data = sx.read_payload()
+                total[burst][0] += sx.slave.transactions
+                total[burst][1] += sx.slave.elapsed
+                print(f"{len(data):3d} bytes", "burst" if burst else "per-byte", sx.slave)
+        for burst in (False, True):
+            print("burst" if burst else "per-byte", f"{total[burst][0]/frames:.1f} transactions/frame", f"{total[burst][1]/frames*1000:.2f} ms/frame")
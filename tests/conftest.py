@@ -0,0 +1,17 @@
+import os
+import sys
+from types import SimpleNamespace
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def entry():
+    """
+    Builds TxScheduler entries with the attributes it reads off main.PendingTX,
+    which cannot be imported without the GUI toolkit
+    """
+    def make(packetID, priority, lifetime=None):
+        return SimpleNamespace(packetID=packetID, priority=priority, lifetime=lifetime, cancelled=False)
+    return make
@@ -0,0 +1,63 @@
+import pytest
+from airtime import AirtimeLedger, SlidingWindow
+from scheduler import TxScheduler, Priority
+
+def test_window_roll_off():
+    window = SlidingWindow(60)
+    window.add(1, 0)
+    window.add(2, 30)
+    assert window.sum(59) == 3
+    # The first bucket is a minute old
+    assert window.sum(60) == 2
+    assert window.sum(90) == 0
+
+def test_utilization():
+    ledger = AirtimeLedger()
+    ledger.addRx(6, now=0)
+    ledger.addTx(3, now=0)
+    assert ledger.channelUtilization(now=1) == pytest.approx(15)
+    assert ledger.txUtilization(now=1) == pytest.approx(3 / 3600 * 100)
+    assert ledger.channelUtilization(now=61) == 0
+    assert ledger.txUtilization(now=61) == pytest.approx(3 / 3600 * 100)
+
+def test_refuses_only_low_priorities():
+    ledger = AirtimeLedger(channelLimit=25)
+    ledger.addRx(20, now=0)
+    for priority in (Priority.ROUTING, Priority.TEXT):
+        assert ledger.allows(priority, now=1)
+    for priority in (Priority.RELAY, Priority.PERIODIC):
+        assert not ledger.allows(priority, now=1)
+    # Channel window rolled over
+    assert ledger.allows(Priority.RELAY, now=61)
+
+def test_duty_cycle_budget():
+    # 10% duty cycle, relays may use half of it: 180s an hour
+    ledger = AirtimeLedger(dutyCycle=10, politeDutyCycle=50)
+    ledger.addTx(180, now=0)
+    assert not ledger.allows(Priority.RELAY, now=120)
+    assert ledger.allows(Priority.TEXT, now=120)
+    assert ledger.allows(Priority.RELAY, now=3600)
+
+def test_scheduler_defers_and_counts_once(entry):
+    ledger = AirtimeLedger()
+    scheduler = TxScheduler(ledger)
+    scheduler.push(entry(b"relay", Priority.RELAY), 0)
+    ledger.addRx(20, now=0)
+    for now in range(1, 10):
+        assert scheduler.pop(now) is None
+    assert ledger.stats["deferred"] == 1
+    scheduler.push(entry(b"text", Priority.TEXT), 10)
+    assert scheduler.pop(10).packetID == b"text"
+    assert scheduler.pop(61).packetID == b"relay"
+
+def test_deferred_relay_expires(entry):
+    ledger = AirtimeLedger()
+    scheduler = TxScheduler(ledger)
+    scheduler.push(entry(b"relay", Priority.RELAY, lifetime=5), 0)
+    scheduler.push(entry(b"nodeinfo", Priority.PERIODIC), 0)
+    ledger.addRx(20, now=0)
+    assert scheduler.pop(1) is None
+    # Budget back, the relay is stale by now
+    assert scheduler.pop(61).packetID == b"nodeinfo"
+    assert scheduler.stats["expired"] == 1
+    assert len(scheduler) == 0
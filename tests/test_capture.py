@@ -0,0 +1,30 @@
+import os
+from capture import Capture, CaptureWriter
+
+def writeRecords(path, timestamps):
+    writer = CaptureWriter(path)
+    for timestamp in timestamps:
+        writer.write(timestamp, bytes(20), -80, 8, True)
+    writer.close()
+
+def test_reopen_after_torn_tail(tmp_path):
+    path = str(tmp_path / "torn.cap")
+    writeRecords(path, [1, 2, 3])
+    # Killed in the middle of the last frame
+    os.truncate(path, os.path.getsize(path) - 10)
+    writeRecords(path, [4, 5, 6])
+    writeRecords(path, [7])
+    with Capture(path) as capture:
+        assert [record.timestamp for record in capture] == [1, 2, 4, 5, 6, 7]
+        assert all(len(record.frame) == 20 for record in capture)
+    # The index rebuilt from the data file agrees
+    os.remove(path + ".idx")
+    with Capture(path) as capture:
+        assert [record.timestamp for record in capture] == [1, 2, 4, 5, 6, 7]
+
+def test_torn_record_header(tmp_path):
+    path = str(tmp_path / "header.cap")
+    writeRecords(path, [1, 2])
+    os.truncate(path, os.path.getsize(path) - 20 - Capture.RECORD.size + 5)
+    with Capture(path) as capture:
+        assert [record.timestamp for record in capture] == [1]
@@ -0,0 +1,50 @@
+import random
+import pytest
+from rtt import RttEstimator
+
+def test_seed_from_hops():
+    rtt = RttEstimator()
+    # Unknown node, DEFAULT_HOPS there and back: SRTT 3s, RTTVAR 1.5s
+    assert rtt.rto(b"a", 0.5) == pytest.approx(9)
+    rtt.observeHops(b"a", 1)
+    assert rtt.rto(b"a", 0.5) == pytest.approx(3)
+    # Out of range hop counts are ignored
+    rtt.observeHops(b"a", -2)
+    assert rtt.rto(b"a", 0.5) == pytest.approx(3)
+
+def test_srtt_rttvar_after_samples():
+    rtt = RttEstimator()
+    rtt.sample(b"a", 1.0)
+    assert rtt.peers[b"a"] == pytest.approx((1.0, 0.5))
+    rtt.sample(b"a", 2.0)
+    srtt, rttvar = rtt.peers[b"a"]
+    assert rttvar == pytest.approx(0.75 * 0.5 + 0.25 * 1.0)
+    assert srtt == pytest.approx(0.875 * 1.0 + 0.125 * 2.0)
+    rtt.sample(b"a", 2.0)
+    assert rtt.peers[b"a"] == pytest.approx((0.875 * 1.125 + 0.125 * 2.0, 0.75 * 0.625 + 0.25 * 0.875))
+    # Sampled, the hop seed no longer applies
+    srtt, rttvar = rtt.peers[b"a"]
+    assert rtt.rto(b"a", 100) == pytest.approx(srtt + 4 * rttvar)
+
+def test_rto_bounds():
+    rtt = RttEstimator()
+    rtt.sample(b"fast", 0.01)
+    assert rtt.rto(b"fast", 0) == RttEstimator.MIN_RTO
+    rtt.sample(b"slow", 1000)
+    assert rtt.rto(b"slow", 0) == RttEstimator.MAX_RTO
+
+def test_backoff_doubles_with_jitter():
+    rtt = RttEstimator()
+    rtt.sample(b"a", 2.0)
+    rto = rtt.rto(b"a", 0)
+    for attempt in (1, 2, 3):
+        timeout = rtt.timeout(b"a", attempt, 0)
+        base = rto * 2 ** (attempt - 1)
+        assert base <= timeout <= base * (1 + RttEstimator.JITTER)
+
+def test_backoff_capped_after_jitter(monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda a, b: b)
+    rtt = RttEstimator()
+    rtt.sample(b"a", 10.0)
+    assert rtt.timeout(b"a", 8, 0) == RttEstimator.MAX_RTO
+    assert rtt.timeout(b"a", 1, 0) == pytest.approx(rtt.rto(b"a", 0) * (1 + RttEstimator.JITTER))
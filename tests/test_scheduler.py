@@ -0,0 +1,60 @@
+import pytest
+from scheduler import TxScheduler, Priority
+
+def test_nothing_before_due(entry):
+    scheduler = TxScheduler()
+    scheduler.push(entry(b"a", Priority.TEXT), 10)
+    assert scheduler.pop(9) is None
+    assert scheduler.pop(10).packetID == b"a"
+    assert len(scheduler) == 0
+
+def test_priority_order_among_due(entry):
+    scheduler = TxScheduler()
+    scheduler.push(entry(b"periodic", Priority.PERIODIC), 1)
+    scheduler.push(entry(b"relay", Priority.RELAY), 2)
+    scheduler.push(entry(b"text2", Priority.TEXT), 4)
+    scheduler.push(entry(b"text1", Priority.TEXT), 3)
+    scheduler.push(entry(b"routing", Priority.ROUTING), 5)
+    scheduler.push(entry(b"later", Priority.ROUTING), 100)
+    order = [scheduler.pop(10).packetID for _ in range(5)]
+    # Ties within a class go in due order
+    assert order == [b"routing", b"text1", b"text2", b"relay", b"periodic"]
+    assert scheduler.pop(10) is None
+    assert len(scheduler) == 1
+
+def test_cancel_due_entry(entry):
+    scheduler = TxScheduler()
+    scheduler.push(entry(b"a", Priority.TEXT), 1)
+    scheduler.push(entry(b"b", Priority.RELAY), 1)
+    # Promoted to ready, then cancelled
+    assert scheduler.pop(1).packetID == b"a"
+    scheduler.push(entry(b"c", Priority.TEXT), 5)
+    assert scheduler.cancel(b"b").packetID == b"b"
+    assert scheduler.cancel(b"b") is None
+    assert len(scheduler) == 1
+    assert scheduler.pop(10).packetID == b"c"
+    assert scheduler.pop(10) is None
+    assert scheduler.stats["depth"][Priority.RELAY.name] == 0
+    assert scheduler.stats["cancelled"] == 1
+
+def test_push_replaces_same_packet_id(entry):
+    scheduler = TxScheduler()
+    first = entry(b"a", Priority.TEXT)
+    scheduler.push(first, 1)
+    scheduler.push(entry(b"a", Priority.RELAY), 2)
+    assert len(scheduler) == 1
+    assert scheduler.stats["depth"][Priority.TEXT.name] == 0
+    assert scheduler.pop(10).priority == Priority.RELAY
+    assert scheduler.pop(10) is None
+    with pytest.raises(Exception):
+        second = entry(b"b", Priority.TEXT)
+        scheduler.push(second, 1)
+        scheduler.push(second, 2)
+
+def test_lifetime_expiry(entry):
+    scheduler = TxScheduler()
+    scheduler.push(entry(b"stale", Priority.RELAY, lifetime=5), 0)
+    scheduler.push(entry(b"kept", Priority.PERIODIC), 0)
+    assert scheduler.pop(6).packetID == b"kept"
+    assert scheduler.stats["expired"] == 1
+    assert len(scheduler) == 0
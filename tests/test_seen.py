@@ -0,0 +1,42 @@
+from seen import SeenCache
+
+def test_check_records_and_hits():
+    seen = SeenCache(ttl=10)
+    assert not seen.check("a", now=0)
+    assert seen.check("a", now=1)
+    assert seen.stats["hits"] == 1
+    assert seen.stats["misses"] == 1
+
+def test_ttl_expiry():
+    seen = SeenCache(ttl=10)
+    seen.check("a", now=0)
+    seen.check("b", now=5)
+    # a is 10s old, b is not
+    assert not seen.check("a", now=10)
+    assert seen.check("b", now=10)
+
+def test_hit_refreshes_ttl():
+    seen = SeenCache(ttl=10)
+    seen.check("a", now=0)
+    seen.check("a", now=8)
+    assert seen.check("a", now=15)
+
+def test_size_cap_evicts_least_recently_seen():
+    seen = SeenCache(ttl=100, maxSize=3)
+    for i, key in enumerate("abc"):
+        seen.check(key, now=i)
+    # a seen again, b is now the least recent
+    seen.check("a", now=3)
+    seen.check("d", now=4)
+    assert len(seen) == 3
+    assert seen.stats["evictions"] == 1
+    assert list(seen.entries) == ["c", "a", "d"]
+
+def test_add_does_not_count():
+    seen = SeenCache(ttl=10, maxSize=2)
+    seen.add("a", now=0)
+    seen.add("b", now=1)
+    seen.add("c", now=2)
+    assert list(seen.entries) == ["b", "c"]
+    assert seen.stats["hits"] == 0 and seen.stats["misses"] == 0
+    assert seen.check("c", now=3)
@@ -0,0 +1,131 @@
+import random
+import time
+from radio import LoRa
+
+class Transceiver:
+    """
+    Common base of the radio drivers.
+
+    The shadow maps a register address or command opcode to the last value
+    written to it, so configuration that did not change is not sent again.
+    Anything that makes the chip lose or change its state behind our back
+    (reset, sleep, timeouts) has to invalidate() it.
+    """
+    TX_TIMEOUT_MARGIN = 0.1
+
+    # Smallest frame worth waiting for, the Meshtastic header
+    RX_MIN_LENGTH = 16
+
+    # Contention slot for listen-before-talk backoff, as in the Meshtastic firmware:
+    # CAD duration plus propagation, RX/TX turnaround and MAC processing
+    LBT_SLOT_SYMBOLS = 8.5
+    LBT_SLOT_OVERHEAD = 0.0076
+    LBT_MAX_EXPONENT = 5
+
+    # Rebroadcast contention window, in slots as a power of two, scaled by SNR
+    CW_MIN = 3
+    CW_MAX = 8
+    CW_SNR_MIN = -20
+    CW_SNR_MAX = 10
+
+    def __init__(self):
+        self.shadow = {}
+        self.setRxPolling()
+        self.rxDetected = None
+        # Set by the first receive(), the driver then keeps itself listening across TX and errors
+        self.continuous = False
+        # Listen before talk, send() returns False without transmitting when CAD finds the channel busy
+        self.lbt = False
+
+    def setListenBeforeTalk(self, lbt: bool):
+        self.lbt = lbt
+
+    def channelBusy(self):
+        return self.lbt and self.cad()
+
+    def lbtBackoff(self, attempt):
+        """
+        Random binary exponential backoff, in seconds, before retrying a send() refused for a busy channel
+        """
+        slots = random.randint(1, 2 ** min(attempt, Transceiver.LBT_MAX_EXPONENT))
+        return slots * self.slotTime()
+
+    def slotTime(self):
+        return Transceiver.LBT_SLOT_SYMBOLS * self.symbolTime() + Transceiver.LBT_SLOT_OVERHEAD
+
+    def relayDelay(self, snr):
+        """
+        Seconds to hold a rebroadcast, as the firmware does for clients: the
+        better a frame was heard the longer we wait, so the farthest nodes relay
+        first and the rest hear them and cancel.
+        """
+        if snr is None:
+            snr = Transceiver.CW_SNR_MAX
+        snr = min(max(snr, Transceiver.CW_SNR_MIN), Transceiver.CW_SNR_MAX)
+        cw = int((snr - Transceiver.CW_SNR_MIN) * (Transceiver.CW_MAX - Transceiver.CW_MIN) / (Transceiver.CW_SNR_MAX - Transceiver.CW_SNR_MIN) + Transceiver.CW_MIN)
+        slots = 2 * Transceiver.CW_MAX + random.randint(0, 2 ** cw)
+        return slots * self.slotTime()
+
+    def relayWindow(self):
+        """
+        Seconds of the longest rebroadcast hold, the whole contention window
+        """
+        return (2 * Transceiver.CW_MAX + 2 ** Transceiver.CW_MAX) * self.slotTime()
+
+    def hopTime(self, length):
+        """
+        Seconds a frame of length bytes takes to cross one hop: on air plus the shortest relay hold
+        """
+        return self.timeOnAir(length) + 2 * Transceiver.CW_MAX * self.slotTime()
+
+    def setRxPolling(self, idleSymbols=16, activeSymbols=1, minInterval=0.002, maxInterval=0.2):
+        """
+        wait_rx polls every idleSymbols while nothing is on the air, and every
+        activeSymbols once a preamble or header has been flagged, within
+        [minInterval, maxInterval] seconds.
+        """
+        self.rxIdleSymbols = idleSymbols
+        self.rxActiveSymbols = activeSymbols
+        self.rxMinInterval = minInterval
+        self.rxMaxInterval = maxInterval
+
+    def symbolTime(self):
+        return LoRa.symbolTime(self.bw, self.sf)
+
+    def timeOnAir(self, length):
+        return LoRa.timeOnAir(length, self.bw, self.sf, self.cr, self.preambleLength, self.implicitHeader, self.crc)
+
+    def rxPollInterval(self, preamble=False, header=False):
+        """
+        Return:
+            seconds to wait before polling the IRQ flags again
+            None if the flags are stale (no header after the preamble, or no end after the header), the caller should clear them
+        """
+        now = time.time()
+        symbolTime = self.symbolTime()
+        if not preamble and not header:
+            self.rxDetected = None
+            interval = self.rxIdleSymbols * symbolTime
+        else:
+            if self.rxDetected is None:
+                self.rxDetected = now
+            headerTime = (self.preambleLength + 4.25 + 8) * symbolTime
+            if now - self.rxDetected > (self.timeOnAir(255) if header else headerTime) * 2:
+                self.rxDetected = None
+                return None
+            if header:
+                # No frame can end before the smallest payload is through
+                remaining = self.timeOnAir(Transceiver.RX_MIN_LENGTH) - headerTime
+                interval = max(self.rxDetected + remaining - now, self.rxActiveSymbols * symbolTime)
+            else:
+                interval = self.rxActiveSymbols * symbolTime
+        return min(max(interval, self.rxMinInterval), self.rxMaxInterval)
+
+    def isShadowed(self, key, value):
+        return key in self.shadow and self.shadow[key] == value
+
+    def invalidate(self, *keys):
+        if not keys:
+            self.shadow.clear()
+        for key in keys:
+            self.shadow.pop(key, None)
@@ -0,0 +1,268 @@
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from radio import LoRa, Meshtastic
+from transceiver import Transceiver
+
+class Medium:
+    """
+    In-process radio channel shared by every VirtualTransceiver attached to it.
+    Frames reach the other radios tuned to the same channel once their time on air is over.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.radios = []
+        self.busyUntil = {}
+
+    def attach(self, radio):
+        with self.lock:
+            self.radios.append(radio)
+
+    def detach(self, radio):
+        with self.lock:
+            self.radios.remove(radio)
+
+    def transmit(self, sender, channel, frame, duration):
+        start = time.time()
+        end = start + duration
+        with self.lock:
+            self.busyUntil[channel] = max(self.busyUntil.get(channel, 0), end)
+            radios = [r for r in self.radios if r is not sender]
+        for radio in radios:
+            radio.deliver(channel, frame, start, end)
+
+    def busy(self, channel):
+        with self.lock:
+            return time.time() < self.busyUntil.get(channel, 0)
+
+class UdpMedium(Medium):
+    """
+    Medium spanning processes or hosts through UDP multicast, every datagram carries one frame.
+    """
+    HEADER = struct.Struct("!8sdIBBBB") # origin, duration, frequency, bw, sf, cr, sync
+
+    def __init__(self, group="239.0.0.1", port=4403):
+        super().__init__()
+        self.origin = os.urandom(8)
+        self.group = group
+        self.port = port
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.sock.bind(("", port))
+        mreq = struct.pack("4sl", socket.inet_aton(group), socket.INADDR_ANY)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+        self.thread = threading.Thread(target=self.looper, daemon=True)
+        self.thread.start()
+
+    def transmit(self, sender, channel, frame, duration):
+        super().transmit(sender, channel, frame, duration)
+        header = UdpMedium.HEADER.pack(self.origin, duration, *channel)
+        self.sock.sendto(header + frame, (self.group, self.port))
+
+    def looper(self):
+        while True:
+            data = self.sock.recv(UdpMedium.HEADER.size + 256)
+            if len(data) < UdpMedium.HEADER.size:
+                continue
+            origin, duration, *channel = UdpMedium.HEADER.unpack_from(data)
+            if origin == self.origin:
+                # Already delivered in-process
+                continue
+            Medium.transmit(self, None, tuple(channel), data[UdpMedium.HEADER.size:], duration)
+
+class VirtualTransceiver(Transceiver):
+    """
+    Hardware-free stand-in for SX126x/SX127x, with the same interface as far as Client is concerned.
+    """
+    CFG_MEDIUM = "medium"
+    CFG_GROUP = "group"
+    CFG_PORT = "port"
+    CFG_LOSS = "loss"
+    CFG_RSSI = "rssi"
+    CFG_SNR = "snr"
+    CFG_TIME_SCALE = "time_scale"
+
+    media = {}
+
+    def __init__(self, params=None, medium=None):
+        super().__init__()
+
+        if params is None:
+            params = {}
+        params = dict(params)
+        params[VirtualTransceiver.CFG_MEDIUM] = params.get(VirtualTransceiver.CFG_MEDIUM) or "local"
+        params[VirtualTransceiver.CFG_GROUP] = params.get(VirtualTransceiver.CFG_GROUP) or "239.0.0.1"
+        params[VirtualTransceiver.CFG_PORT] = int(params.get(VirtualTransceiver.CFG_PORT) or "4403")
+        params[VirtualTransceiver.CFG_LOSS] = float(params.get(VirtualTransceiver.CFG_LOSS) or "0")
+        params[VirtualTransceiver.CFG_RSSI] = float(params.get(VirtualTransceiver.CFG_RSSI) or "-80")
+        params[VirtualTransceiver.CFG_SNR] = float(params.get(VirtualTransceiver.CFG_SNR) or "8")
+        params[VirtualTransceiver.CFG_TIME_SCALE] = float(params.get(VirtualTransceiver.CFG_TIME_SCALE) or "1")
+        self.params = params
+
+        if medium is None:
+            medium = VirtualTransceiver.getMedium(params)
+        self.medium = medium
+
+        self.bw = LoRa.BandWidth.BW_125K
+        self.cr = LoRa.CodingRate.CR_4_5
+        self.implicitHeader = False
+        self.sf = LoRa.SpreadingFactor.SF_128
+        self.crc = True
+        self.sync = 0x12
+        self.preambleLength = 8
+        self.freq = 0
+
+        self.cond = threading.Condition()
+        self.rxQueue = deque()
+        self.rxFrame = None
+        self.listening = False
+        self.txUntil = 0
+        self.medium.attach(self)
+
+    @classmethod
+    def getMedium(cls, params):
+        # One medium per process and kind, so radios created from the same config hear each other
+        if params[cls.CFG_MEDIUM] == "udp":
+            key = ("udp", params[cls.CFG_GROUP], params[cls.CFG_PORT])
+            if key not in cls.media:
+                cls.media[key] = UdpMedium(params[cls.CFG_GROUP], params[cls.CFG_PORT])
+        elif params[cls.CFG_MEDIUM] == "local":
+            key = ("local",)
+            if key not in cls.media:
+                cls.media[key] = Medium()
+        else:
+            raise Exception(f"Virtual: Unsupported medium {params[cls.CFG_MEDIUM]}")
+        return cls.media[key]
+
+    @property
+    def channel(self):
+        return (int(self.freq), self.bw, self.sf, self.cr, self.sync)
+
+    def deliver(self, channel, frame, start, end):
+        if channel != self.channel:
+            return
+        if random.random() < self.params[VirtualTransceiver.CFG_LOSS]:
+            return
+        with self.cond:
+            if not self.listening or start < self.txUntil:
+                # Half duplex, nothing is heard while transmitting
+                return
+            self.rxQueue.append((end, bytes(frame)))
+            self.cond.notify_all()
+
+    def scaledTimeOnAir(self, length):
+        return self.timeOnAir(length) * self.params[VirtualTransceiver.CFG_TIME_SCALE]
+
+    def standby(self):
+        with self.cond:
+            self.listening = False
+
+    def sleep(self):
+        self.standby()
+
+    def receive(self):
+        self.continuous = True
+        with self.cond:
+            self.listening = True
+
+    def wait_rx(self, timeout=3):
+        """
+        Return:
+            True if RX_DONE
+            None if RX_TIMEOUT
+        """
+        t0 = time.time()
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.rxQueue:
+                    end, frame = self.rxQueue[0]
+                    if end <= now:
+                        self.rxQueue.popleft()
+                        self.rxFrame = frame
+                        return True
+                    wait = end - now
+                else:
+                    wait = t0 + timeout - now
+                if now - t0 >= timeout:
+                    return None
+                self.cond.wait(min(wait, t0 + timeout - now))
+
+    def read_payload(self):
+        frame, self.rxFrame = self.rxFrame, None
+        return frame or b""
+
+    def readRssiSnr(self):
+        return self.params[VirtualTransceiver.CFG_RSSI], self.params[VirtualTransceiver.CFG_SNR]
+
+    def cad(self):
+        return self.medium.busy(self.channel)
+
+    def send(self, data):
+        """
+        Return:
+            True once transmitted
+            False if listen before talk found the channel busy, nothing was sent
+        """
+        if self.channelBusy():
+            return False
+        duration = self.scaledTimeOnAir(len(data))
+        with self.cond:
+            self.txUntil = time.time() + duration
+        self.medium.transmit(self, self.channel, bytes(data), duration)
+        time.sleep(duration)
+        if self.continuous:
+            self.receive()
+        return True
+
+    def setMeshtastic(self, region="TW", preset="LONG_FAST", slot=None):
+        regionCfg = Meshtastic.REGION.get(region, "TW")
+        presetCfg = Meshtastic.PRESETS.get(preset, "LONG_FAST")
+
+        if not slot:
+            slot = regionCfg["defaultSlot"]
+
+        bw = LoRa.BandWidthMap[presetCfg["bw"]]
+        freq = regionCfg["startFreq"] + bw/2 + bw*(slot-1)
+
+        if freq > regionCfg["endFreq"]:
+            raise Exception(f"Frequency {freq} out of range {regionCfg['startFreq']} - {regionCfg['endFreq']}")
+
+        self.freq = freq
+        self.bw = presetCfg["bw"]
+        self.sf = presetCfg["sf"]
+        self.cr = presetCfg["cr"]
+        self.implicitHeader = False
+        self.crc = True
+        self.sync = 0x2B
+        self.preambleLength = Meshtastic.PREAMBLE_LENGTH
+
+if __name__ == "__main__":
+    import sys
+
+    # Two radios on the local medium, one sends frames as fast as the air allows
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    params = {VirtualTransceiver.CFG_TIME_SCALE: "0.001"}
+    a = VirtualTransceiver(params)
+    b = VirtualTransceiver(params)
+    for x in (a, b):
+        x.setMeshtastic("TW", "LONG_FAST")
+    b.receive()
+
+    data = b'\xff\xff\xff\xffp\x87\xa8\xbb\xe0\xa5/^c\x08\x00\x00\x01\x8ey=\x87\xfc4\xdc\xbd#'
+    t0 = time.time()
+    received = 0
+    for i in range(frames):
+        a.send(data)
+        if b.wait_rx(1) and b.read_payload() == data:
+            received += 1
+    elapsed = time.time() - t0
+    print(f"{received}/{frames} frames in {elapsed:.3f}s, {frames/elapsed*60:.0f} frames/min")